@@ -4,11 +4,24 @@ Modified version of DQN implementation by Tejas Kulkarni found at
 https://github.com/mrkulk/deepQN_tensorflow
 
 """
-import numpy as np
 import tensorflow.compat.v1 as tf
 tf.disable_eager_execution()
 
 
+def session_config(params):
+    """ Session configuration from the agent's thread, graph optimizer and
+    XLA params """
+    config = tf.ConfigProto(
+        intra_op_parallelism_threads=params['intra_op_threads'],
+        inter_op_parallelism_threads=params['inter_op_threads'])
+    optimizer_options = config.graph_options.optimizer_options
+    optimizer_options.opt_level = getattr(tf.OptimizerOptions,
+                                          params['graph_opt_level'])
+    if params['xla_jit']:
+        optimizer_options.global_jit_level = tf.OptimizerOptions.ON_1
+    return config
+
+
 class DQN:
     """
     INITALIZING THE Deep-Q-Learning Model
@@ -16,15 +29,24 @@ class DQN:
     def __init__(self, params):
         self.params = params
         self.network_name = 'qnet'
-        self.sess = tf.Session()
-        self._x = tf.placeholder(
+        # The agent's only session
+        self.sess = tf.Session(config=session_config(params))
+        # Walls are fed once per layout and broadcast over the batch of
+        # dynamic planes; _x can still be fed whole observations directly
+        self.walls = tf.placeholder(
             "float",
-            [None, params['width'], params['height'], 6],
-            name=self.network_name + '_x')
-        self.q_t = tf.placeholder(
+            [None, params['width'], params['height'], 1],
+            name=self.network_name + '_walls')
+        self.planes = tf.placeholder(
             "float",
-            [None],
-            name=self.network_name + '_q_t')
+            [None, params['width'], params['height'], 5],
+            name=self.network_name + '_planes')
+        self.next_planes = tf.placeholder(
+            "float",
+            [None, params['width'], params['height'], 5],
+            name=self.network_name + '_next_planes')
+        self._x = self.observations(self.planes, '_x')
+        self.next_x = self.observations(self.next_planes, '_next_x')
         self.actions = tf.placeholder(
             "float",
             [None, 4],
@@ -35,92 +57,49 @@ class DQN:
         self.terminals = tf.placeholder("float",
                                         [None],
                                         name=self.network_name + '_terminals')
+        # Importance-sampling weights of prioritized replay, 1 otherwise
+        self.weights = tf.placeholder_with_default(
+            tf.ones_like(self.rewards),
+            [None],
+            name=self.network_name + '_weights')
+
+        self.layers = self.create_layers(self.network_name)
+        self._y = self.forward(self._x, self.layers, self.network_name)
+        # Greedy actions with ties between equal Q-values broken uniformly
+        # at random, for action selection
+        self.max_q = tf.reduce_max(self._y, axis=1)
+        self.greedy_action = tf.argmax(
+            tf.where(tf.equal(self._y, tf.expand_dims(self.max_q, 1)),
+                     tf.random_uniform(tf.shape(self._y)),
+                     -tf.ones_like(self._y)),
+            axis=1)
 
-        # Layer 1 (Convolutional)
-        layer_name = 'conv1'
-        size = 3
-        channels = 6
-        filters = 16
-        stride = 1
-
-        self.w_1 = tf.Variable(
-            tf.random_normal([size, size, channels, filters], stddev=0.01),
-            name=self.network_name + '_' + layer_name + '_weights')
-        self.b_1 = tf.Variable(
-            tf.constant(0.1, shape=[filters]),
-            name=self.network_name + '_' + layer_name + '_biases')
-        self.c_1 = tf.nn.conv2d(
-            self._x,
-            self.w_1,
-            strides=[1, stride, stride, 1],
-            padding='SAME',
-            name=self.network_name+'_'+layer_name+'_convs')
-        self.o_1 = tf.nn.relu(
-            tf.add(self.c_1, self.b_1),
-            name=self.network_name+'_'+layer_name+'_activations')
-
-        # Layer 2 (Convolutional)
-        layer_name = 'conv2'
-        size = 3
-        channels = 16
-        filters = 32
-        stride = 1
-
-        self.w_2 = tf.Variable(
-            tf.random_normal([size, size, channels, filters], stddev=0.01),
-            name=self.network_name+'_'+layer_name+'_weights')
-        self.b_2 = tf.Variable(
-            tf.constant(0.1, shape=[filters]),
-            name=self.network_name + '_' + layer_name + '_biases')
-        self.c_2 = tf.nn.conv2d(
-            self.o_1,
-            self.w_2,
-            strides=[1, stride, stride, 1],
-            padding='SAME',
-            name=self.network_name+'_'+layer_name+'_convs')
-        self.o_2 = tf.nn.relu(
-            tf.add(self.c_2, self.b_2),
-            name=self.network_name+'_'+layer_name+'_activations')
-
-        o2_shape = self.o_2.get_shape().as_list()
-
-        # Layer 3 (Fully connected)
-        layer_name = 'fc3'
-        hiddens = 256
-        dim = o2_shape[1] * o2_shape[2] * o2_shape[3]
-        self.o2_flat = tf.reshape(
-            self.o_2,
-            [-1, dim],
-            name=self.network_name+'_'+layer_name+'_input_flat')
-        self.w_3 = tf.Variable(
-            tf.random_normal([dim, hiddens], stddev=0.01),
-            name=self.network_name+'_'+layer_name+'_weights')
-        self.b_3 = tf.Variable(
-            tf.constant(0.1, shape=[hiddens]),
-            name=self.network_name+'_'+layer_name+'_biases')
-        self.ip3 = tf.add(tf.matmul(self.o2_flat, self.w_3),
-                          self.b_3,
-                          name=self.network_name + '_' + layer_name + '_ips')
-        self.o_3 = tf.nn.relu(
-            self.ip3,
-            name=self.network_name + '_' + layer_name + '_activations')
-
-        # Layer 4
-        layer_name = 'fc4'
-        hiddens = 4
-        dim = 256
-        self.w_4 = tf.Variable(
-            tf.random_normal([dim, hiddens], stddev=0.01),
-            name=self.network_name + '_' + layer_name + '_weights')
-        self.b_4 = tf.Variable(
-            tf.constant(0.1, shape=[hiddens]),
-            name=self.network_name+'_'+layer_name+'_biases')
-        self._y = tf.add(
-            tf.matmul(self.o_3, self.w_4),
-            self.b_4,
-            name=self.network_name+'_'+layer_name+'_outputs')
+        # Optional frozen copy of the layers that next-state values are
+        # taken from, synced from qnet every target_update updates
+        self.target_layers = None
+        self.sync_target = None
+        if self.params['target_update']:
+            self.target_layers = self.create_layers('target',
+                                                    trainable=False)
+            self.sync_target = tf.group(
+                *[tf.assign(target, online)
+                  for online_layer, target_layer
+                  in zip(self.layers, self.target_layers)
+                  for online, target
+                  in zip(online_layer[1:], target_layer[1:])],
+                name='target_sync')
 
         # Q,Cost,Optimizer
+        # The bootstrap value max_a' Q(s', a') is computed in the same
+        # session call as the update, unless q_t is fed explicitly
+        next_y = self.forward(self.next_x,
+                              self.target_layers or self.layers,
+                              self.network_name + '_next')
+        self.next_q = tf.stop_gradient(tf.reduce_max(next_y, axis=1))
+        self.q_t = tf.placeholder_with_default(
+            self.next_q,
+            [None],
+            name=self.network_name + '_q_t')
         self.discount = tf.constant(self.params['discount'])
         self.y_j = tf.add(
             self.rewards,
@@ -128,8 +107,9 @@ class DQN:
                         tf.multiply(self.discount, self.q_t)))
         self.q_pred = tf.reduce_sum(tf.multiply(self._y, self.actions),
                                     reduction_indices=1)
-        self.cost = tf.reduce_sum(tf.pow(
-            tf.subtract(self.y_j, self.q_pred), 2))
+        self.td_errors = tf.subtract(self.y_j, self.q_pred)
+        self.cost = tf.reduce_sum(
+            tf.multiply(self.weights, tf.pow(self.td_errors, 2)))
 
         if self.params['load_file'] is not None:
             self.global_step = tf.Variable(
@@ -144,48 +124,138 @@ class DQN:
         self.optim = tf.train.AdamOptimizer(
             self.params['lr']).minimize(self.cost,
                                         global_step=self.global_step)
-        self.saver = tf.train.Saver(max_to_keep=0)
+        # The target network is a copy of qnet and is not checkpointed
+        target_names = set()
+        for _, weights, biases in self.target_layers or []:
+            target_names.update([weights.name, biases.name])
+        self.saver = tf.train.Saver(
+            [variable for variable in tf.global_variables()
+             if variable.name not in target_names],
+            max_to_keep=0)
 
         self.sess.run(tf.global_variables_initializer())
 
         if self.params['load_file'] is not None:
             print('Loading checkpoint...')
             self.saver.restore(self.sess, self.params['load_file'])
+        if self.sync_target is not None:
+            self.sess.run(self.sync_target)
 
-    def train(self, bat_s, bat_a, bat_t, bat_n, bat_r):
+        # Feeds only the observations and skips building a feed dict and
+        # fetch list on every move
+        self.greedy_callable = self.sess.make_callable(
+            [self.greedy_action, self.max_q], feed_list=[self._x])
+
+    def observations(self, planes, name):
+        """ Whole observations: the walls placeholder broadcast over a
+        batch of dynamic planes """
+        walls = tf.broadcast_to(
+            self.walls,
+            tf.concat([tf.shape(planes)[:3], [1]], axis=0))
+        return tf.concat([walls, planes], axis=3,
+                         name=self.network_name + name)
+
+    def create_layers(self, network_name, trainable=True):
+        """ Weights and biases of the conv1, conv2, fc3 and fc4 layers, as
+        (name, weights, biases) tuples """
+        width, height = self.params['width'], self.params['height']
+        # (layer, weights shape) for 3x3 convolutions and dense layers;
+        # SAME padding and stride 1 keep the board size through conv2
+        shapes = [('conv1', [3, 3, 6, 16]),
+                  ('conv2', [3, 3, 16, 32]),
+                  ('fc3', [width * height * 32, 256]),
+                  ('fc4', [256, 4])]
+        layers = []
+        for layer_name, shape in shapes:
+            weights = tf.Variable(
+                tf.random_normal(shape, stddev=0.01),
+                trainable=trainable,
+                name=network_name + '_' + layer_name + '_weights')
+            biases = tf.Variable(
+                tf.constant(0.1, shape=[shape[-1]]),
+                trainable=trainable,
+                name=network_name + '_' + layer_name + '_biases')
+            layers.append((layer_name, weights, biases))
+        return layers
+
+    def forward(self, x, layers, name):
+        """ Q-values of the observations x under layers """
+        (_, w_1, b_1), (_, w_2, b_2), (_, w_3, b_3), (_, w_4, b_4) = layers
+        o_1 = tf.nn.relu(
+            tf.add(tf.nn.conv2d(x, w_1, strides=[1, 1, 1, 1],
+                                padding='SAME'), b_1),
+            name=name + '_conv1_activations')
+        o_2 = tf.nn.relu(
+            tf.add(tf.nn.conv2d(o_1, w_2, strides=[1, 1, 1, 1],
+                                padding='SAME'), b_2),
+            name=name + '_conv2_activations')
+        o2_flat = tf.reshape(o_2, [-1, w_3.get_shape().as_list()[0]],
+                             name=name + '_fc3_input_flat')
+        o_3 = tf.nn.relu(tf.add(tf.matmul(o2_flat, w_3), b_3),
+                         name=name + '_fc3_activations')
+        return tf.add(tf.matmul(o_3, w_4), b_4,
+                      name=name + '_fc4_outputs')
+
+    def greedy(self, observations):
+        """ Greedy actions and their Q-values for a batch of whole
+        observations, shaped (batch, width, height, 6) """
+        return self.greedy_callable(observations)
+
+    def target_q(self, bat_n, bat_w):
+        """ max_a' Q(s', a') of next states for train's q_t. With a target
+        network this does not change until the next sync, so it can be
+        computed for upcoming batches ahead of time """
+        return self.sess.run(self.next_q,
+                             feed_dict={self.next_planes: bat_n,
+                                        self.walls: bat_w})
+
+    def train(self, bat_s, bat_a, bat_t, bat_n, bat_r, bat_w,
+              weights=None, q_t=None):
         """Specifrom_y Training Parameters
 
         Parameters
         ----------
         bat_s
+            dynamic planes (all but walls) of the states
         bat_a
         bat_t
         bat_n
+            dynamic planes of the next states
         bat_r
+        bat_w
+            walls planes, one per state or a single one for the batch
+        weights
+            importance-sampling weights of the samples' squared errors,
+            all 1 if None
+        q_t
+            next-state values from target_q, computed in the same call
+            if None
 
         Returns
         -------
         cnt
         cost
+        td_errors
+            per-sample TD errors before the update
 
         """
-        feed_dict = {self._x: bat_n,
-                     self.q_t: np.zeros(bat_n.shape[0]),
-                     self.actions: bat_a,
-                     self.terminals: bat_t,
-                     self.rewards: bat_r}
-        q_t = self.sess.run(self._y,
-                            feed_dict=feed_dict)
-        q_t = np.amax(q_t, axis=1)
-        feed_dict = {self._x: bat_s,
-                     self.q_t: q_t,
+        feed_dict = {self.planes: bat_s,
+                     self.next_planes: bat_n,
+                     self.walls: bat_w,
                      self.actions: bat_a,
                      self.terminals: bat_t,
                      self.rewards: bat_r}
-        _, cnt, cost = self.sess.run(
-            [self.optim, self.global_step, self.cost],
+        if weights is not None:
+            feed_dict[self.weights] = weights
+        if q_t is not None:
+            feed_dict[self.q_t] = q_t
+        _, cnt, cost, td_errors = self.sess.run(
+            [self.optim, self.global_step, self.cost, self.td_errors],
             feed_dict=feed_dict)
-        return cnt, cost
+        if self.sync_target is not None \
+                and cnt % self.params['target_update'] == 0:
+            self.sess.run(self.sync_target)
+        return cnt, cost, td_errors
 
     def save_ckpt(self, filename):
         """
@@ -0,0 +1,424 @@
+"""
+fast_pacman.py
+# -------------
+A compact forward model of classic Pacman for rollouts and data generation.
+
+FastGameState implements the same rules as PacmanRules, GhostRules and
+ClassicGameRules in pacman.py (scoring, TIME_PENALTY, SCARED_TIME, the
+collision tolerance and half-speed scared ghosts) but keeps the whole state
+in a handful of integers:
+
+  * agent positions in half-cell units, so scared ghosts stay integral
+  * headings as indices into LegalActionTable.DIRECTIONS
+  * food and capsules as bitsets over the cells of the board
+
+Run this module to step it in lockstep with pacman.GameState on every
+bundled layout and report the throughput of both:
+
+> python fast_pacman.py
+"""
+import os
+import random
+import sys
+import time
+
+import numpy as np
+
+import layout as layout_module
+from game import Directions, LegalActionTable
+from pacman import GameState
+from pacman import SCARED_TIME, COLLISION_TOLERANCE, TIME_PENALTY
+
+DIRECTIONS = LegalActionTable.DIRECTIONS
+DIRECTION_INDEX = {direction: i for i, direction in enumerate(DIRECTIONS)}
+STOP = DIRECTION_INDEX[Directions.STOP]
+# Movement per direction index, in half-cell units at full speed
+DELTA_X = [0, 0, 2, -2, 0]
+DELTA_Y = [2, -2, 0, 0, 0]
+# Manhattan distance within which a ghost and Pacman collide, in half cells
+KILL_DISTANCE = int(2 * COLLISION_TOLERANCE)
+
+FAST_LAYOUTS = {}
+
+
+def start_positions(layout, num_ghost_agents):
+    """Half-cell start positions of Pacman and the first num_ghost_agents
+    ghosts of a layout, in agent order"""
+    starts = []
+    num_ghosts = 0
+    for is_pac, (x_pos, y_pos) in layout.agent_positions:
+        if not is_pac:
+            if num_ghosts == num_ghost_agents:
+                continue
+            num_ghosts += 1
+        starts.append((2 * x_pos, 2 * y_pos))
+    return starts
+
+
+class FastLayout:
+    """
+    The static part of a layout in the integer encoding: legal action
+    indices per cell (and per heading for ghosts) and the agents' start
+    positions. Built once per Layout and shared by every FastGameState.
+    """
+
+    def __init__(self, layout, num_ghost_agents):
+        self.layout = layout
+        self.width = layout.width
+        self.height = layout.height
+        table = layout.legal_actions
+        cells = self.width * self.height
+        self.pacman_actions = [()] * cells
+        self.ghost_actions = [None] * cells
+        for (x_pos, y_pos), actions in table.pacman_actions.items():
+            cell = x_pos * self.height + y_pos
+            self.pacman_actions[cell] = tuple(
+                DIRECTION_INDEX[action] for action in actions)
+            self.ghost_actions[cell] = [
+                tuple(DIRECTION_INDEX[action] for action in
+                      table.ghost_actions[((x_pos, y_pos), heading)])
+                for heading in DIRECTIONS]
+
+        self.starts = start_positions(layout, num_ghost_agents)
+
+    @staticmethod
+    def for_layout(layout, num_ghost_agents):
+        """Get the shared FastLayout for a layout"""
+        key = (layout, num_ghost_agents)
+        fast_layout = FAST_LAYOUTS.get(key)
+        if fast_layout is None:
+            fast_layout = FastLayout(layout, num_ghost_agents)
+            FAST_LAYOUTS[key] = fast_layout
+        return fast_layout
+
+    def cell_bits(self, grid):
+        """Encode a boolean Grid as a bitset over cells"""
+        packed = np.packbits(grid.data.reshape(-1), bitorder='little')
+        return int.from_bytes(packed.tobytes(), 'little')
+
+    def position_bits(self, positions):
+        """Encode a list of (x, y) cells as a bitset"""
+        bits = 0
+        for x_pos, y_pos in positions:
+            bits |= 1 << (x_pos * self.height + y_pos)
+        return bits
+
+
+class FastGameState:
+    """
+    A mutable, integer-encoded game state. apply() advances it in place;
+    generate_successor() mirrors pacman.GameState and returns a new state.
+    """
+    __slots__ = ('static', 'x_pos', 'y_pos', 'heading', 'scared', 'food',
+                 'num_food', 'capsules', 'score', 'win', 'lose')
+
+    def __init__(self, static):
+        """An empty board of static; the factories below fill it in"""
+        self.static = static
+        self.x_pos = []
+        self.y_pos = []
+        self.heading = []
+        self.scared = []
+        self.food = 0
+        self.num_food = 0
+        self.capsules = 0
+        self.score = 0
+        self.win = False
+        self.lose = False
+
+    @staticmethod
+    def from_layout(layout, num_ghost_agents=1000):
+        """Creates an initial state, as GameState.initialize does"""
+        static = FastLayout.for_layout(layout, num_ghost_agents)
+        state = FastGameState(static)
+        state.x_pos = [x_pos for x_pos, _ in static.starts]
+        state.y_pos = [y_pos for _, y_pos in static.starts]
+        state.heading = [STOP] * len(static.starts)
+        state.scared = [0] * len(static.starts)
+        state.food = static.cell_bits(layout.food)
+        state.num_food = layout.food.count()
+        state.capsules = static.position_bits(layout.capsules)
+        return state
+
+    @staticmethod
+    def from_game_state(game_state):
+        """Encodes a pacman.GameState"""
+        data = game_state.data
+        static = FastLayout.for_layout(data.layout,
+                                       len(data.agent_states) - 1)
+        state = FastGameState(static)
+        for agent_state in data.agent_states:
+            x_pos, y_pos = agent_state.configuration.pos
+            state.x_pos.append(int(round(2 * x_pos)))
+            state.y_pos.append(int(round(2 * y_pos)))
+            state.heading.append(
+                DIRECTION_INDEX[agent_state.configuration.direction])
+            state.scared.append(agent_state.scared_timer)
+        state.food = static.cell_bits(data.food)
+        state.num_food = data.food.count()
+        state.capsules = static.position_bits(data.capsules)
+        state.score = data.score
+        state.win = data.win
+        state.lose = data.lose
+        return state
+
+    def clone(self):
+        """Copy the state"""
+        state = FastGameState(self.static)
+        state.x_pos = self.x_pos[:]
+        state.y_pos = self.y_pos[:]
+        state.heading = self.heading[:]
+        state.scared = self.scared[:]
+        state.food = self.food
+        state.num_food = self.num_food
+        state.capsules = self.capsules
+        state.score = self.score
+        state.win = self.win
+        state.lose = self.lose
+        return state
+
+    def get_num_agents(self):
+        " Get Number of Agents "
+        return len(self.x_pos)
+
+    def get_score(self):
+        " Get Total Score "
+        return float(self.score)
+
+    def iswin(self):
+        " Check if it is a winning position "
+        return self.win
+
+    def islose(self):
+        " Check if it is a losing position "
+        return self.lose
+
+    def legal_action_indices(self, agent_index):
+        """Legal actions of an agent as direction indices"""
+        if self.win or self.lose:
+            return ()
+        x_pos, y_pos = self.x_pos[agent_index], self.y_pos[agent_index]
+        heading = self.heading[agent_index]
+        if x_pos & 1 or y_pos & 1:
+            # Between grid points agents must continue straight
+            if agent_index and heading == STOP:
+                return ()
+            return (heading,)
+        cell = (x_pos >> 1) * self.static.height + (y_pos >> 1)
+        if agent_index == 0:
+            return self.static.pacman_actions[cell]
+        return self.static.ghost_actions[cell][heading]
+
+    def get_legal_actions(self, agent_index=0):
+        """Legal actions of an agent as Directions"""
+        return [DIRECTIONS[i] for i in self.legal_action_indices(agent_index)]
+
+    def generate_successor(self, agent_index, action):
+        """Returns the successor after the agent takes action (a Direction)"""
+        state = self.clone()
+        state.apply(agent_index, DIRECTION_INDEX[action])
+        return state
+
+    def apply(self, agent_index, action):
+        """Advances the state in place by one agent taking a direction index"""
+        if self.win or self.lose:
+            raise UserWarning("Can't generate a successor of terminal state")
+        if action not in self.legal_action_indices(agent_index):
+            raise UserWarning("Illegal action " + DIRECTIONS[action])
+        self._move(agent_index, action)
+
+    def _move(self, agent_index, action):
+        # Rules of PacmanRules/GhostRules.apply_action, decrement_timer and
+        # check_death for an action already known to be legal
+        x_list, y_list = self.x_pos, self.y_pos
+        if agent_index == 0:
+            x_pos = x_list[0] + DELTA_X[action]
+            y_pos = y_list[0] + DELTA_Y[action]
+            x_list[0], y_list[0] = x_pos, y_pos
+            if action != STOP:
+                self.heading[0] = action
+            score_change = self._consume(x_pos, y_pos) - TIME_PENALTY
+            for ghost in range(1, len(x_list)):
+                if (abs(x_list[ghost] - x_pos)
+                        + abs(y_list[ghost] - y_pos) <= KILL_DISTANCE):
+                    score_change += self._collide(ghost)
+        else:
+            timer = self.scared[agent_index]
+            x_pos, y_pos = DELTA_X[action], DELTA_Y[action]
+            if timer > 0:
+                # Scared ghosts move at half speed
+                x_pos, y_pos = x_pos // 2, y_pos // 2
+                if timer == 1:
+                    # Snap back onto the grid as the ghost stops being scared
+                    x_pos = 2 * ((x_list[agent_index] + x_pos + 1) >> 1)
+                    y_pos = 2 * ((y_list[agent_index] + y_pos + 1) >> 1)
+                else:
+                    x_pos += x_list[agent_index]
+                    y_pos += y_list[agent_index]
+                self.scared[agent_index] = timer - 1
+            else:
+                x_pos += x_list[agent_index]
+                y_pos += y_list[agent_index]
+            x_list[agent_index], y_list[agent_index] = x_pos, y_pos
+            if action != STOP:
+                self.heading[agent_index] = action
+            score_change = 0
+            if (abs(x_list[0] - x_pos)
+                    + abs(y_list[0] - y_pos) <= KILL_DISTANCE):
+                score_change = self._collide(agent_index)
+        self.score += score_change
+
+    def random_playout(self, rng, agent_index=0, max_moves=100000):
+        """
+        Plays uniformly random legal moves for every agent, in place, until
+        the game ends or max_moves moves were made. Returns the number of
+        moves played.
+        """
+        num_agents = len(self.x_pos)
+        x_list, y_list, headings = self.x_pos, self.y_pos, self.heading
+        height = self.static.height
+        pacman_actions = self.static.pacman_actions
+        ghost_actions = self.static.ghost_actions
+        move = self._move
+        rand = rng.random
+        moves = 0
+        while moves < max_moves and not (self.win or self.lose):
+            x_pos, y_pos = x_list[agent_index], y_list[agent_index]
+            if x_pos & 1 or y_pos & 1:
+                legal = (headings[agent_index],)
+            elif agent_index == 0:
+                legal = pacman_actions[(x_pos >> 1) * height + (y_pos >> 1)]
+            else:
+                legal = ghost_actions[(x_pos >> 1) * height + (y_pos >> 1)][
+                    headings[agent_index]]
+            move(agent_index, legal[int(rand() * len(legal))])
+            agent_index = (agent_index + 1) % num_agents
+            moves += 1
+        return moves
+
+    def _consume(self, x_pos, y_pos):
+        score_change = 0
+        bit = 1 << ((x_pos >> 1) * self.static.height + (y_pos >> 1))
+        if self.food & bit:
+            score_change += 10
+            self.food ^= bit
+            self.num_food -= 1
+            if self.num_food == 0 and not self.lose:
+                score_change += 500
+                self.win = True
+        if self.capsules & bit:
+            self.capsules ^= bit
+            for ghost in range(1, len(self.scared)):
+                self.scared[ghost] = SCARED_TIME
+        return score_change
+
+    def _collide(self, ghost):
+        if self.scared[ghost] > 0:
+            self.x_pos[ghost], self.y_pos[ghost] = self.static.starts[ghost]
+            self.heading[ghost] = STOP
+            self.scared[ghost] = 0
+            return 200
+        if not self.win:
+            self.lose = True
+            return -500
+        return 0
+
+    def describe_mismatch(self, game_state):
+        """
+        Compares this state with a pacman.GameState and returns a
+        description of the first difference, or None if they agree.
+        """
+        expected = FastGameState.from_game_state(game_state)
+        for field in ('x_pos', 'y_pos', 'heading', 'scared', 'food',
+                      'num_food', 'capsules', 'score', 'win', 'lose'):
+            if getattr(self, field) != getattr(expected, field):
+                return (f'{field}: fast={getattr(self, field)} '
+                        f'engine={getattr(expected, field)}')
+        return None
+
+
+def run_conformance(layout_names=None, games=5, seed=0, max_steps=3000):
+    """
+    Plays random games on each layout with pacman.GameState and
+    FastGameState in lockstep, checking legal actions and the full state
+    after every move. Raises AssertionError on the first divergence and
+    returns the number of moves checked per layout.
+    """
+    layout_dir = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                              'layouts')
+    if layout_names is None:
+        layout_names = sorted(name[:-4] for name in os.listdir(layout_dir)
+                              if name.endswith('.lay'))
+    rng = random.Random(seed)
+    checked = {}
+    for name in layout_names:
+        layout = layout_module.try_to_load(
+            os.path.join(layout_dir, name + '.lay'))
+        checked[name] = 0
+        for game_number in range(games):
+            state = GameState()
+            state.initialize(layout, layout.get_num_ghosts())
+            fast = FastGameState.from_layout(layout, layout.get_num_ghosts())
+            agent_index, num_agents = 0, state.get_num_agents()
+            for _ in range(max_steps):
+                legal = state.get_legal_actions(agent_index)
+                if legal != fast.get_legal_actions(agent_index):
+                    raise AssertionError(
+                        f'{name} game {game_number}: legal actions of agent '
+                        f'{agent_index} differ: engine={legal} '
+                        f'fast={fast.get_legal_actions(agent_index)}')
+                if not legal:
+                    break
+                action = rng.choice(legal)
+                state = state.generate_successor(agent_index, action)
+                fast = fast.generate_successor(agent_index, action)
+                mismatch = fast.describe_mismatch(state)
+                if mismatch is not None:
+                    raise AssertionError(
+                        f'{name} game {game_number} move {checked[name]}: '
+                        f'{mismatch}')
+                checked[name] += 1
+                agent_index = (agent_index + 1) % num_agents
+    return checked
+
+
+def measure_throughput(layout, num_ghost_agents, moves=50000, seed=0):
+    """
+    Random-playout moves per second of GameState and of FastGameState,
+    restarting from the initial state whenever a game ends.
+    """
+    initial = GameState()
+    initial.initialize(layout, num_ghost_agents)
+    rng = random.Random(seed)
+    done = 0
+    start_time = time.perf_counter()
+    while done < moves:
+        state, agent_index = initial, 0
+        while done < moves and not (state.iswin() or state.islose()):
+            legal = state.get_legal_actions(agent_index)
+            state = state.generate_successor(
+                agent_index, legal[int(rng.random() * len(legal))])
+            agent_index = (agent_index + 1) % state.get_num_agents()
+            done += 1
+    engine_rate = moves / (time.perf_counter() - start_time)
+
+    fast_initial = FastGameState.from_layout(layout, num_ghost_agents)
+    rng = random.Random(seed)
+    done = 0
+    start_time = time.perf_counter()
+    while done < moves:
+        done += fast_initial.clone().random_playout(rng,
+                                                    max_moves=moves - done)
+    return engine_rate, moves / (time.perf_counter() - start_time)
+
+
+if __name__ == '__main__':
+    for layout_name, matched in run_conformance().items():
+        print(f'{layout_name:16s} {matched:6d} moves match')
+    medium = layout_module.get_layout('mediumClassic')
+    game_state_rate, fast_rate = measure_throughput(medium,
+                                                    medium.get_num_ghosts())
+    print(f'mediumClassic: GameState {game_state_rate:.0f} moves/s, '
+          f'FastGameState {fast_rate:.0f} moves/s '
+          f'({fast_rate / game_state_rate:.1f}x)')
+    sys.exit(0)
@@ -22,10 +22,11 @@ Attribution Information: The Pacman AI projects were developed at UC Berkeley.
 
 # from util import *
 import io
-import time
+import random
 import traceback
 import sys
-from util import TimeoutFunctionException, TimeoutFunction
+import numpy as np
+from util import Deadline, TimeoutFunctionException, TimeoutFunction
 from util import nearest_point, raise_not_defined
 #######################
 # Parts worth reading #
@@ -184,11 +185,15 @@ class AgentState:
 
 class Grid:
     """
-    A 2-dimensional array of objects backed by a list of lists.
+    A 2-dimensional array of booleans backed by a contiguous NumPy buffer.
     Data is accessed via grid[x_pos][y_pos] where (x_pos,y_pos) are positions
     on a Pacman map with x_pos horizontal, y_pos vertical and
     the origin (0,0) in the bottom left corner.
 
+    The buffer has shape (width, height), so grid[x_pos] is a writable view
+    of one column and whole-grid operations (copy, count, equality, hashing)
+    run as vectorized array operations.
+
     The __str__ method constructs an output that is oriented
     like a pacman board.
     """
@@ -204,8 +209,7 @@ class Grid:
 
         self.width = width
         self.height = height
-        self.data = [[initial_value for y_pos in range(
-            height)] for x_pos in range(width)]
+        self.data = np.full((width, height), bool(initial_value), dtype=bool)
         if bit_representation:
             self._unpack_bits(bit_representation)
 
@@ -216,7 +220,7 @@ class Grid:
         self.data[key] = item
 
     def __str__(self):
-        out = [[str(self.data[x][y])[0] for x in range(self.width)]
+        out = [[str(bool(self.data[x][y]))[0] for x in range(self.width)]
                for y in range(self.height)]
         out.reverse()
         return '\n'.join([''.join(x) for x in out])
@@ -224,23 +228,19 @@ class Grid:
     def __eq__(self, other):
         if other is None:
             return False
-        return self.data == other.data
+        return np.array_equal(self.data, other.data)
 
     def __hash__(self):
-        # return hash(str(self))
-        base = 1
-        hash_code = 0
-        for data in self.data:
-            for i in data:
-                if i:
-                    hash_code += base
-                base *= 2
-        return hash(hash_code)
+        return hash((self.width, self.height,
+                     np.packbits(self.data).tobytes()))
 
     def copy(self):
         """Copy the grid"""
-        grid = Grid(self.width, self.height)
-        grid.data = [x[:] for x in self.data]
+        grid = Grid.__new__(Grid)
+        grid.cells_per_int = self.cells_per_int
+        grid.width = self.width
+        grid.height = self.height
+        grid.data = self.data.copy()
         return grid
 
     def deep_copy(self):
@@ -249,22 +249,24 @@ class Grid:
 
     def shallow_copy(self):
         """Shallow copy"""
-        grid = Grid(self.width, self.height)
+        grid = Grid.__new__(Grid)
+        grid.cells_per_int = self.cells_per_int
+        grid.width = self.width
+        grid.height = self.height
         grid.data = self.data
         return grid
 
     def count(self, item=True):
         """Count the total"""
-        return sum(x.count(item) for x in self.data)
+        found = int(np.count_nonzero(self.data))
+        if item:
+            return found
+        return self.data.size - found
 
     def as_list(self, key=True):
         """Convert to list"""
-        lst = []
-        for width in range(self.width):
-            for height in range(self.height):
-                if self[width][height] == key:
-                    lst.append((width, height))
-        return lst
+        cells = np.argwhere(self.data == bool(key))
+        return [(int(x_pos), int(y_pos)) for x_pos, y_pos in cells]
 
     def pack_bits(self):
         """
@@ -273,21 +275,19 @@ class Grid:
         (width, height, bitPackedInts...)
         """
         bits = [self.width, self.height]
-        current_int = 0
-        for i in range(self.height * self.width):
-            bit = self.cells_per_int - (i % self.cells_per_int) - 1
-            x_width, y_height = self.cell_index_to_position(i)
-            if self[x_width][y_height]:
-                current_int += 2 ** bit
-            if (i + 1) % self.cells_per_int == 0:
-                bits.append(current_int)
-                current_int = 0
-        bits.append(current_int)
+        cells = self.data.reshape(-1)
+        weights = 2 ** np.arange(self.cells_per_int - 1, -1, -1,
+                                 dtype=np.int64)
+        for start in range(0, cells.size, self.cells_per_int):
+            chunk = cells[start:start + self.cells_per_int]
+            bits.append(int(np.dot(chunk, weights[:chunk.size])))
+        if cells.size % self.cells_per_int == 0:
+            bits.append(0)
         return tuple(bits)
 
     def cell_index_to_position(self, index):
         """Index the cell to its correct position"""
-        x_pos = index / self.height
+        x_pos = index // self.height
         y_pos = index % self.height
         return x_pos, y_pos
 
@@ -295,14 +295,12 @@ class Grid:
         """
         Fills in data from a bit-level representation
         """
-        cell = 0
+        cells = []
         for packed in bits:
-            for bit in self._unpack_int(packed, self.cells_per_int):
-                if cell == self.width * self.height:
-                    break
-                x_pos, y_pos = self.cell_index_to_position(cell)
-                self[x_pos][y_pos] = bit
-                cell += 1
+            cells.extend(self._unpack_int(packed, self.cells_per_int))
+        size = self.width * self.height
+        self.data = np.array(cells[:size], dtype=bool).reshape(
+            self.width, self.height)
 
     def _unpack_int(self, packed, size):
         bools = []
@@ -424,9 +422,156 @@ class Actions:
         return (x_pos + deri_x, y_pos + derivate_y)
 
 
+class LegalActionTable:
+    """
+    Legal actions for every open cell of a layout, computed once when the
+    layout is loaded.
+
+    masks maps a cell to a bitmask over DIRECTIONS (bit i set when
+    DIRECTIONS[i] is legal there). pacman_actions maps a cell to its legal
+    actions and ghost_actions maps (cell, heading) to the actions a ghost
+    may take: no stopping and no reversing unless at a dead end. Agents
+    between grid points (half-speed scared ghosts) are not in the tables
+    and fall back to Actions.get_possible_actions, which keeps them going
+    straight.
+    """
+    DIRECTIONS = [direction for direction, _ in Actions._directionsas_list]
+
+    def __init__(self, walls):
+        self.walls = walls
+        self.masks = {}
+        self.pacman_actions = {}
+        self.ghost_actions = {}
+        for x_pos in range(walls.width):
+            for y_pos in range(walls.height):
+                if walls[x_pos][y_pos]:
+                    continue
+                cell = (x_pos, y_pos)
+                mask = 0
+                for bit, (_, vec) in enumerate(Actions._directionsas_list):
+                    if not walls[x_pos + vec[0]][y_pos + vec[1]]:
+                        mask |= 1 << bit
+                self.masks[cell] = mask
+                possible = [direction for bit, direction in
+                            enumerate(self.DIRECTIONS) if mask & (1 << bit)]
+                self.pacman_actions[cell] = tuple(possible)
+                for heading in self.DIRECTIONS:
+                    self.ghost_actions[(cell, heading)] = tuple(
+                        self.ghost_filter(possible, heading))
+
+    @staticmethod
+    def ghost_filter(possible_actions, heading):
+        """Drop Stop, and the reverse of heading unless it is the only way"""
+        possible_actions = [action for action in possible_actions
+                            if action != Directions.STOP]
+        reverse = Actions.reverse_direction(heading)
+        if reverse in possible_actions and len(possible_actions) > 1:
+            possible_actions.remove(reverse)
+        return possible_actions
+
+    @staticmethod
+    def off_grid(config):
+        """Whether config is between grid points, as half-speed scared
+        ghosts are every other move"""
+        x_pos, y_pos = config.pos
+        return (abs(x_pos - int(x_pos + 0.5))
+                + abs(y_pos - int(y_pos + 0.5)) > Actions.TOLERANCE)
+
+    def get_pacman_actions(self, config):
+        """Legal actions for an agent in configuration config"""
+        actions = self.pacman_actions.get(config.pos)
+        if actions is None:
+            if self.off_grid(config):
+                # In between grid points agents must continue straight
+                return (config.direction,)
+            return tuple(Actions.get_possible_actions(config, self.walls))
+        return actions
+
+    def get_ghost_actions(self, config):
+        """Legal actions for a ghost in configuration config"""
+        actions = self.ghost_actions.get((config.pos, config.direction))
+        if actions is None:
+            if self.off_grid(config):
+                # Straight on, and ghosts never stop
+                if config.direction == Directions.STOP:
+                    return ()
+                return (config.direction,)
+            return tuple(self.ghost_filter(
+                Actions.get_possible_actions(config, self.walls),
+                config.direction))
+        return actions
+
+
+ZOBRIST_TABLES = {}
+
+
+class ZobristTable:
+    """
+    Random 64-bit keys for the mutable parts of a game state on a board of a
+    given size: food cells, capsule cells and, per agent, its position,
+    direction and scared timer.
+
+    A state's Zobrist hash is the XOR of the keys of everything it contains,
+    so eating food, consuming a capsule, moving an agent or changing a
+    scared timer updates the hash with a couple of XORs.
+    """
+
+    def __init__(self, width, height, seed=0):
+        self.width = width
+        self.height = height
+        self._random = random.Random(seed)
+        cells = width * height
+        self.food = [self._random.getrandbits(64) for _ in range(cells)]
+        self.capsules = [self._random.getrandbits(64) for _ in range(cells)]
+        self._agent_keys = {}
+
+    def food_key(self, position):
+        """Key of a food pellet at position"""
+        x_pos, y_pos = position
+        return self.food[x_pos * self.height + y_pos]
+
+    def capsule_key(self, position):
+        """Key of a capsule at position"""
+        x_pos, y_pos = position
+        return self.capsules[x_pos * self.height + y_pos]
+
+    def agent_key(self, agent_index, agent_state):
+        """Key of an agent's configuration and scared timer"""
+        configuration = agent_state.configuration
+        if configuration is None:
+            return 0
+        return (self._lookup(('pos', agent_index, configuration.pos))
+                ^ self._lookup(('dir', agent_index, configuration.direction))
+                ^ self._lookup(('scared', agent_index,
+                                agent_state.scared_timer)))
+
+    def _lookup(self, feature):
+        # Agent positions may be fractional (half-speed ghosts), so these
+        # keys are drawn lazily rather than tabulated up front
+        key = self._agent_keys.get(feature)
+        if key is None:
+            key = self._random.getrandbits(64)
+            self._agent_keys[feature] = key
+        return key
+
+
+def get_zobrist_table(width, height):
+    """Get the shared Zobrist table for a board size"""
+    table = ZOBRIST_TABLES.get((width, height))
+    if table is None:
+        table = ZobristTable(width, height)
+        ZOBRIST_TABLES[(width, height)] = table
+    return table
+
+
 class GameStateData:
     """
     Get state of the game
+
+    Successors and deep copies share the layout, the food grid, the capsule
+    list and the agent states with their predecessor. The mutators below copy
+    a shared piece the first time it is written, so state changes must go
+    through them rather than editing those fields in place.
     """
 
     def __init__(self, prev_state=None):
@@ -435,12 +580,19 @@ class GameStateData:
         information from its predecessor.
         """
         if prev_state is not None:
-            self.food = prev_state.food.shallow_copy()
-            self.capsules = prev_state.capsules[:]
-            self.agent_states = self.copy_agent_states(prev_state.agent_states)
+            self.food = prev_state.food
+            self.capsules = prev_state.capsules
+            self.agent_states = prev_state.agent_states[:]
             self.layout = prev_state.layout
+            # Copy-on-write bookkeeping: the pieces are now shared, so
+            # neither state owns them until it writes to them
+            self._owns_food = prev_state._owns_food = False
+            self._owns_capsules = prev_state._owns_capsules = False
+            self._owned_agents = prev_state._owned_agents = 0
             self._eaten = prev_state._eaten
             self.score = prev_state.score
+            self._zobrist = prev_state._zobrist
+            self._hash = prev_state._hash
 
         self.food_eaten = None
         self.food_added = None
@@ -453,14 +605,55 @@ class GameStateData:
     def deep_copy(self):
         """Create a deep copy of the data"""
         state = GameStateData(self)
-        state.food = self.food.deep_copy()
-        state.layout = self.layout.deep_copy()
         state.agent_moved = self.agent_moved
         state.food_eaten = self.food_eaten
         state.food_added = self.food_added
         state.capsule_eaten = self.capsule_eaten
         return state
 
+    def set_agent_configuration(self, agent_index, configuration):
+        """Move an agent, keeping the Zobrist hash up to date"""
+        agent_state = self._agent_for_write(agent_index)
+        self._hash ^= self._zobrist.agent_key(agent_index, agent_state)
+        agent_state.configuration = configuration
+        self._hash ^= self._zobrist.agent_key(agent_index, agent_state)
+
+    def set_scared_timer(self, agent_index, scared_timer):
+        """Set an agent's scared timer, keeping the Zobrist hash up to date"""
+        if self.agent_states[agent_index].scared_timer == scared_timer:
+            return
+        agent_state = self._agent_for_write(agent_index)
+        self._hash ^= self._zobrist.agent_key(agent_index, agent_state)
+        agent_state.scared_timer = scared_timer
+        self._hash ^= self._zobrist.agent_key(agent_index, agent_state)
+
+    def remove_food(self, position):
+        """Eat the food pellet at position"""
+        x_pos, y_pos = position
+        if not self._owns_food:
+            self.food = self.food.copy()
+            self._owns_food = True
+        self.food[x_pos][y_pos] = False
+        self.food_eaten = position
+        self._hash ^= self._zobrist.food_key(position)
+
+    def remove_capsule(self, position):
+        """Consume the capsule at position"""
+        if not self._owns_capsules:
+            self.capsules = self.capsules[:]
+            self._owns_capsules = True
+        self.capsules.remove(position)
+        self.capsule_eaten = position
+        self._hash ^= self._zobrist.capsule_key(position)
+
+    def _agent_for_write(self, agent_index):
+        """Return an agent state that is safe to modify in place"""
+        if not self._owned_agents & (1 << agent_index):
+            agent_state = self.agent_states[agent_index].copy()
+            self.agent_states[agent_index] = agent_state
+            self._owned_agents |= 1 << agent_index
+        return self.agent_states[agent_index]
+
     def copy_agent_states(self, agent_states):
         """Copy agent states"""
         copied_states = []
@@ -488,21 +681,16 @@ class GameStateData:
     def __hash__(self):
         """
         Allows states to be keys of dictionaries.
+
+        The Zobrist hash is maintained incrementally by the mutators above,
+        so this is O(1) regardless of board size.
         """
-        for _, state in enumerate(self.agent_states):
-            try:
-                int(hash(state))
-            except TypeError(Exception):
-                print(Exception)
-                # hash(state)
-        return int((hash(tuple(self.agent_states))
-                    + 13 * hash(self.food) +
-                    113 * hash(tuple(self.capsules))
-                    + 7 * hash(self.score)) % 1048575)
+        return self._hash ^ hash(self.score)
 
     def __str__(self):
         width, height = self.layout.width, self.layout.height
-        map_game = Grid(width, height)
+        # Grid cells are boolean, so the character map is a plain list
+        map_game = [[' ' for _ in range(height)] for _ in range(width)]
         if isinstance(self.food, type((1, 2))):
             self.food = reconstitute_grid(self.food)
         for x_pos in range(width):
@@ -528,7 +716,9 @@ class GameStateData:
         for x_pos, y_pos in self.capsules:
             map_game[x_pos][y_pos] = 'o'
 
-        return str(map_game) + f"\nScore: {self.score}\n"
+        rows = [''.join(map_game[x_pos][y_pos] for x_pos in range(width))
+                for y_pos in range(height - 1, -1, -1)]
+        return '\n'.join(rows) + f"\nScore: {self.score}\n"
 
     def food_wall_str(self, has_food, has_wall):
         """Check if the food is available"""
@@ -568,6 +758,18 @@ class GameStateData:
             self.agent_states.append(AgentState(
                 Configuration(pos, Directions.STOP), is_pac))
         self._eaten = [False for a in self.agent_states]
+        self._owns_food = True
+        self._owns_capsules = True
+        self._owned_agents = (1 << len(self.agent_states)) - 1
+
+        self._zobrist = get_zobrist_table(layout.width, layout.height)
+        self._hash = 0
+        for position in self.food.as_list():
+            self._hash ^= self._zobrist.food_key(position)
+        for position in self.capsules:
+            self._hash ^= self._zobrist.capsule_key(position)
+        for agent_index, agent_state in enumerate(self.agent_states):
+            self._hash ^= self._zobrist.agent_key(agent_index, agent_state)
 
 
 try:
@@ -596,6 +798,7 @@ class Game:
         self.mute_agents = mute_agents
         self.catch_exceptions = catch_exceptions
         self.move_history = []
+        self.record_history = True
         self.total_agent_times = [0 for agent in agents]
         self.total_agent_time_warnings = [0 for agent in agents]
         self.agent_timeout = False
@@ -613,7 +816,43 @@ class Game:
             traceback.print_exc()
         self.game_over = True
         self.agent_crashed = True
-        self.rules.agentCrash(self, agent_index)
+        self.rules.agent_crash(agent_index)
+
+    def check_move_time(self, agent_index, deadline):
+        """
+        Charges the time spent on a move to the agent and ends the game if
+        the move overran its deadline, drew too many warnings or used up the
+        agent's budget for the game.  Returns True if the game was ended.
+        """
+        move_time = deadline.elapsed()
+        if deadline.expired():
+            print(f"Agent {agent_index} timed out on a single move!",
+                  file=sys.stderr)
+            self.agent_timeout = True
+            self.agent_crash(agent_index, quiet=True)
+            return True
+
+        if move_time > self.rules.get_move_warning_time(agent_index):
+            self.total_agent_time_warnings[agent_index] += 1
+            warnings = self.total_agent_time_warnings[agent_index]
+            print(f"Agent {agent_index} took too long to make a move! "
+                  f"This is warning {warnings}", file=sys.stderr)
+            if warnings > self.rules.get_max_time_warnings(agent_index):
+                print(f"Agent {agent_index} exceeded the maximum number of "
+                      f"warnings: {warnings}", file=sys.stderr)
+                self.agent_timeout = True
+                self.agent_crash(agent_index, quiet=True)
+                return True
+
+        self.total_agent_times[agent_index] += move_time
+        total = self.total_agent_times[agent_index]
+        if total > self.rules.get_max_total_time(agent_index):
+            print(f"Agent {agent_index} ran out of time! (time: {total:.3f})",
+                  file=sys.stderr)
+            self.agent_timeout = True
+            self.agent_crash(agent_index, quiet=True)
+            return True
+        return False
 
     OLD_STDOUT = None
     OLD_STDERR = None
@@ -637,10 +876,69 @@ class Game:
         sys.stdout = OLD_STDOUT
         sys.stderr = OLD_STDERR
 
+    def is_headless(self):
+        """
+        Whether the lean run_headless loop applies: nothing is displayed,
+        agents are neither muted nor timed and exceptions are not caught.
+        """
+        check_null_display = getattr(self.display, 'check_null_display',
+                                     None)
+        return (not self.catch_exceptions and not self.mute_agents
+                and check_null_display is not None and check_null_display())
+
+    def run_headless(self):
+        """
+        Control loop for training and evaluation runs without a display.
+
+        Plays the same game as run(), but resolves each agent's optional
+        methods once per game, hands agents the current state without
+        deep-copying it (successor states are never modified), records
+        move_history only if record_history is set, and skips display
+        updates and progress reporting.
+        """
+        self.num_moves = 0
+        for i, agent in enumerate(self.agents):
+            if not agent:
+                print(f"Agent {i} failed to load")
+                self.agent_crash(i, quiet=True)
+                return
+            if hasattr(agent, 'register_initial_state'):
+                agent.register_initial_state(self.state.deep_copy())
+
+        observers = [getattr(agent, 'observation_function', None)
+                     for agent in self.agents]
+        actors = [agent.get_action for agent in self.agents]
+        history = self.move_history if self.record_history else None
+        rules = self.rules
+        num_agents = len(self.agents)
+        agent_index = self.starting_index
+        state = self.state
+
+        while not self.game_over:
+            observe = observers[agent_index]
+            if observe is None:
+                action = actors[agent_index](state)
+            else:
+                action = actors[agent_index](observe(state))
+            if history is not None:
+                history.append((agent_index, action))
+            state = state.generate_successor(agent_index, action)
+            self.state = state
+            rules.process(state, self)
+            agent_index = (agent_index + 1) % num_agents
+
+        for agent in self.agents:
+            if hasattr(agent, 'final'):
+                agent.final(state)
+
     def run(self):
         """
         Main control loop for game play.
         """
+        if self.is_headless():
+            self.run_headless()
+            return
+
         self.display.initialize(self.state.data)
         self.num_moves = 0
 
@@ -659,26 +957,23 @@ class Game:
             if "register_initial_state" in dir(agent):
                 self.mute(i)
                 if self.catch_exceptions:
+                    timed_func = TimeoutFunction(
+                        agent.register_initial_state,
+                        self.rules.get_max_startup_time(i))
                     try:
-                        timed_func = TimeoutFunction(
-                            agent.register_initial_state,
-                            int(self.rules.getMaxStartupTime(i)))
-                        try:
-                            start_time = time.time()
-                            timed_func(self.state.deep_copy())
-                            time_taken = time.time() - start_time
-                            self.total_agent_times[i] += time_taken
-                        except TimeoutFunctionException:
-                            print(f"Agent {i} ran out of time on startup!",
-                                  file=sys.stderr)
-                            self.unmute()
-                            self.agent_timeout = True
-                            self.agent_crash(i, quiet=True)
-                            return
-                    except Exception(self.data):
+                        timed_func(self.state.deep_copy())
+                    except TimeoutFunctionException:
+                        print(f"Agent {i} ran out of time on startup!",
+                              file=sys.stderr)
+                        self.unmute()
+                        self.agent_timeout = True
+                        self.agent_crash(i, quiet=True)
+                        return
+                    except Exception:
                         self.agent_crash(i, quiet=False)
                         self.unmute()
                         return
+                    self.total_agent_times[i] += timed_func.time_taken
                 else:
                     agent.register_initial_state(self.state.deep_copy())
                 #  could this exceed the total time
@@ -690,25 +985,22 @@ class Game:
         while not self.game_over:
             # Fetch the next agent
             agent = self.agents[agent_index]
-            move_time = 0
-            skip_action = False
+            deadline = None
+            if self.catch_exceptions:
+                # one deadline covers both the observation and the action
+                deadline = Deadline(self.rules.get_move_timeout(agent_index))
 
             # Generate an observation of the state
             if 'observation_function' in dir(agent):
                 self.mute(agent_index)
                 if self.catch_exceptions:
                     try:
-                        timed_func = TimeoutFunction(
-                            agent.observation_function,
-                            int(self.rules.get_moveTimeout(agent_index)))
-                        try:
-                            start_time = time.time()
-                            observation = timed_func(self.state.deep_copy())
-                        except TimeoutFunctionException:
-                            skip_action = True
-                        move_time += time.time() - start_time
-                        self.unmute()
-                    except Exception(self.data):
+                        with deadline:
+                            observation = agent.observation_function(
+                                self.state.deep_copy())
+                    except TimeoutFunctionException:
+                        observation = None
+                    except Exception:
                         self.agent_crash(agent_index, quiet=False)
                         self.unmute()
                         return
@@ -724,72 +1016,30 @@ class Game:
             self.mute(agent_index)
             if self.catch_exceptions:
                 try:
-                    timed_func = TimeoutFunction(agent.get_action, int(
-                        self.rules.get_move_timeout(agent_index)) -
-                        int(move_time))
-                    try:
-                        start_time = time.time()
-                        if skip_action:
-                            raise TimeoutFunctionException()
-                        action = timed_func(observation)
-                    except TimeoutFunctionException:
-                        print("Agent %d timed out on a single move!" %
-                              agent_index, file=sys.stderr)
-                        self.agent_timeout = True
-                        self.agent_crash(agent_index, quiet=True)
-                        self.unmute()
-                        return
-
-                    move_time += time.time() - start_time
-                    rules = self.rules.get_move_warning_time(agent_index)
-                    if move_time > rules:
-                        self.total_agent_time_warnings[agent_index] += 1
-                        print(f"Agent {agent_index} took too long to"
-                              "make a move! This is warning "
-                              "{self.total_agent_time_warnings[agent_index]}",
-                              file=sys.stderr)
-                        f1_agent = self.total_agent_time_warnings[agent_index]
-                        f2_agent = self.rules.getMaxTimeWarnings(agent_index)
-                        if f1_agent > f2_agent:
-                            print(f"Agent {agent_index} exceeded the"
-                                  "maximum number of warnings:"
-                                  "{self.total_agent_time_warnings"
-                                  "[agent_index]}",
-                                  file=sys.stderr)
-                            self.agent_timeout = True
-                            self.agent_crash(agent_index, quiet=True)
-                            self.unmute()
-                            return
-
-                    self.total_agent_times[agent_index] += move_time
-                    # print "Agent: %d, time: %f, total: %f" % (agent_index,
-                    # move_time, self.total_agent_times[agent_index])
-                    flag1 = self.total_agent_times[agent_index]
-                    flag2 = self.rules.get_max_total_time(agent_index)
-                    if flag1 > flag2:
-                        print(f"Agent {agent_index} ran out of time! "
-                              "(time: {self.total_agent_times[agent_index]})",
-                              file=sys.stderr)
-                        self.agent_timeout = True
-                        self.agent_crash(agent_index, quiet=True)
-                        self.unmute()
-                        return
-                    self.unmute()
-                except Exception(self.data):
+                    if not deadline.expired():
+                        with deadline:
+                            action = agent.get_action(observation)
+                except TimeoutFunctionException:
+                    pass
+                except Exception:
                     self.agent_crash(agent_index)
                     self.unmute()
                     return
+                if self.check_move_time(agent_index, deadline):
+                    self.unmute()
+                    return
             else:
                 action = agent.get_action(observation)
             self.unmute()
 
             # Execute the action
-            self.move_history.append((agent_index, action))
+            if self.record_history:
+                self.move_history.append((agent_index, action))
             if self.catch_exceptions:
                 try:
                     self.state = self.state.generate_successor(
                         agent_index, action)
-                except Exception(self.data):
+                except Exception:
                     self.mute(agent_index)
                     self.agent_crash(agent_index)
                     self.unmute()
@@ -818,7 +1068,7 @@ class Game:
                     self.mute(agent_index)
                     agent.final(self.state)
                     self.unmute()
-                except Exception(self.data):
+                except Exception:
                     if not self.catch_exceptions:
                         raise
                     self.agent_crash(agent_index)
@@ -18,6 +18,7 @@ from functools import reduce
 from game import Directions
 from util import manhattan_distance
 from game import Grid
+from game import LegalActionTable
 
 VISIBILITY_MAT_CACHE = {}
 
@@ -25,6 +26,9 @@ VISIBILITY_MAT_CACHE = {}
 class Layout:
     """
     A Layout manages the static information about the game board.
+
+    A Layout is immutable after construction and is shared by reference
+    between every game state played on it.
     """
 
     def __init__(self, layout_text):
@@ -37,7 +41,8 @@ class Layout:
         self.num_ghosts = 0
         self.process_layout_text(layout_text)
         self.layout_text = layout_text
-        self.total_food = len(self.food.as_list())
+        self.total_food = self.food.count()
+        self.legal_actions = LegalActionTable(self.walls)
 
         # self.initializeVisibilityMatrix()
 
@@ -58,7 +63,7 @@ class Layout:
                 Directions.STOP: set()})
             for x_width in range(self.width):
                 for y_height in range(self.height):
-                    if self.walls[x_width][y_height] is False:
+                    if not self.walls[x_width][y_height]:
                         for vec, direction in zip(vecs, dirs):
                             deri_x, deri_y = vec
                             nextx, nexty = x_width + deri_x, y_height + deri_y
@@ -112,8 +117,11 @@ class Layout:
         return "\n".join(self.layout_text)
 
     def deep_copy(self):
-        """Call layout function"""
-        return Layout(self.layout_text[:])
+        """
+        Layouts are never modified once parsed, so copies share this
+        instance instead of re-parsing the layout text.
+        """
+        return self
 
     def process_layout_text(self, layout_text):
         """
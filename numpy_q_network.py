@@ -0,0 +1,88 @@
+"""
+numpy_q_network.py
+# -----------------
+TensorFlow-free inference for PacmanDQN.
+
+export_weights copies the conv1, conv2, fc3 and fc4 weights and biases of
+a DQN checkpoint in saves/ into a single .npz file. NumpyQNetwork loads
+that file and runs the same forward pass as DQN.forward with plain NumPy,
+so processes that only play moves need neither TensorFlow nor the
+training graph.
+
+Export a checkpoint with
+    python numpy_q_network.py saves/model-<name>_<steps>_<episodes> out.npz
+"""
+import sys
+import numpy as np
+
+LAYERS = ('conv1', 'conv2', 'fc3', 'fc4')
+
+
+def export_weights(checkpoint, filename, network_name='qnet'):
+    """ Write the layers of network_name in checkpoint, and its global
+    step, to the .npz file filename """
+    # Only exporting needs TensorFlow
+    import tensorflow.compat.v1 as tf
+    reader = tf.train.NewCheckpointReader(checkpoint)
+    arrays = {'global_step': reader.get_tensor('global_step')}
+    for layer in LAYERS:
+        for kind in ('weights', 'biases'):
+            arrays[layer + '_' + kind] = reader.get_tensor(
+                network_name + '_' + layer + '_' + kind)
+    np.savez(filename, **arrays)
+
+
+def conv3x3(x, weights, biases):
+    """ Stride 1, SAME padded 3x3 convolution of the (batch, width, height,
+    channels) array x followed by a ReLU, as a sum of nine shifted
+    matrix products """
+    width, height = x.shape[1:3]
+    padded = np.pad(x, ((0, 0), (1, 1), (1, 1), (0, 0)))
+    out = np.broadcast_to(
+        biases, x.shape[:3] + (weights.shape[-1],)).copy()
+    for i in range(3):
+        for j in range(3):
+            out += padded[:, i:i + width, j:j + height] @ weights[i, j]
+    return np.maximum(out, 0, out=out)
+
+
+class NumpyQNetwork:
+    """
+    The DQN Q-function, evaluated with NumPy from weights written by
+    export_weights
+    """
+    def __init__(self, filename, rng=np.random):
+        self.rng = rng
+        with np.load(filename) as arrays:
+            self.global_step = int(arrays['global_step'])
+            self.layers = [
+                (layer,
+                 arrays[layer + '_weights'].astype(np.float32),
+                 arrays[layer + '_biases'].astype(np.float32))
+                for layer in LAYERS]
+
+    def forward(self, observations):
+        """ Q-values of a batch of whole observations, shaped (batch,
+        width, height, 6) """
+        (_, w_1, b_1), (_, w_2, b_2), (_, w_3, b_3), (_, w_4, b_4) = \
+            self.layers
+        o_1 = conv3x3(np.asarray(observations, dtype=np.float32), w_1, b_1)
+        o_2 = conv3x3(o_1, w_2, b_2)
+        o_3 = np.maximum(o_2.reshape(len(o_2), -1) @ w_3 + b_3, 0)
+        return o_3 @ w_4 + b_4
+
+    def greedy(self, observations):
+        """ Greedy actions and their Q-values for a batch of whole
+        observations, ties broken uniformly at random as in DQN.greedy """
+        q_values = self.forward(observations)
+        max_q = q_values.max(axis=1)
+        ties = q_values == max_q[:, np.newaxis]
+        actions = np.where(ties, self.rng.random_sample(q_values.shape),
+                           -1.).argmax(axis=1)
+        return actions, max_q
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3:
+        sys.exit('usage: python numpy_q_network.py CHECKPOINT OUTPUT.npz')
+    export_weights(sys.argv[1], sys.argv[2])
@@ -49,10 +49,11 @@ import os
 import pickle
 from game import GameStateData
 from game import Game
-from game import Directions
 from game import Actions
+from game import Configuration
 from util import nearest_point
 from util import manhattan_distance
+from util import make_visit_tracker, VISIT_TRACKERS
 import layout
 from optparse import OptionParser
 import __main__
@@ -89,15 +90,16 @@ class GameState:
     # Accessor methods: use these to access state data #
     ####################################################
 
-    # static variable keeps track of which states have had get_legal_actions
-    # called
-    explored = set()
+    # static visit tracker recording the states successors were generated
+    # from and to (see util.make_visit_tracker); None disables tracking
+    explored = None
 
     @staticmethod
     def get_and_reset_explored():
         " Get / Reset Explorer "
-        tmp = GameState.explored.copy()
-        GameState.explored = set()
+        tmp = GameState.explored
+        if tmp is not None:
+            GameState.explored = tmp.empty_copy()
         return tmp
 
     def get_legal_actions(self, agent_index=0):
@@ -135,7 +137,7 @@ class GameState:
             # Penalty for waiting around
             state.data.score_change += -TIME_PENALTY
         else:
-            GhostRules.decrement_timer(state.data.agent_states[agent_index])
+            GhostRules.decrement_timer(state, agent_index)
 
         # Resolve multi-agent effects
         GhostRules.check_death(state, agent_index)
@@ -143,8 +145,9 @@ class GameState:
         # Book keeping
         state.data.agent_moved = agent_index
         state.data.score += state.data.score_change
-        GameState.explored.add(self)
-        GameState.explored.add(state)
+        if GameState.explored is not None:
+            GameState.explored.add(self)
+            GameState.explored.add(state)
         return state
 
     def get_legal_pacman_actions(self):
@@ -264,7 +267,7 @@ class GameState:
 
     def deep_copy(self):
         "Create a Deep Copy"
-        state = GameState(self)
+        state = GameState()
         state.data = self.data.deep_copy()
         return state
 
@@ -308,8 +311,9 @@ class ClassicGameRules:
     and how the game starts and ends.
     """
 
-    def __init__(self, timeout=30):
+    def __init__(self, timeout=30, move_timeout=None):
         self.timeout = timeout
+        self.move_timeout = move_timeout
 
     def new_game(self, layout, pacmanAgent, ghostAgents,
                  display, quiet=False, catch_exceptions=False):
@@ -356,23 +360,25 @@ class ClassicGameRules:
         else:
             print("A ghost crashed")
 
-    def get_max_total_time(self):
-        " Get Max Time "
+    def get_max_total_time(self, agent_index):
+        " Get Max Time, in seconds, an agent may use over a game "
         return self.timeout
 
-    def get_max_startup_time(self):
-        " Get Max Startup Time "
+    def get_max_startup_time(self, agent_index):
+        " Get Max Startup Time in seconds "
         return self.timeout
 
-    def get_move_warning_time(self):
-        " Get a move Warning Time "
-        return self.timeout
+    def get_move_warning_time(self, agent_index):
+        " Get a move Warning Time in seconds "
+        return self.get_move_timeout(agent_index)
 
-    def get_move_timeout(self):
-        " Get Move Timeout "
-        return self.timeout
+    def get_move_timeout(self, agent_index):
+        " Get Move Timeout in seconds, falling back to the game total "
+        if self.move_timeout is None:
+            return self.timeout
+        return self.move_timeout
 
-    def get_max_time_warnings(self):
+    def get_max_time_warnings(self, agent_index):
         " Get Maximum Number of Warnings "
         return 0
 
@@ -389,16 +395,16 @@ class PacmanRules:
         """
         Returns a list of possible actions.
         """
-        return Actions.get_possible_actions(
-            state.get_pacman_state().configuration,
-            state.data.layout.walls)
+        return list(state.data.layout.legal_actions.get_pacman_actions(
+            state.data.agent_states[0].configuration))
 
     @staticmethod
     def apply_action(state, action):
         """
         Edits the state to reflect the results of the action.
         """
-        legal = PacmanRules.get_legal_actions(state)
+        legal = state.data.layout.legal_actions.get_pacman_actions(
+            state.data.agent_states[0].configuration)
         if action not in legal:
             raise UserWarning("Illegal action " + str(action))
 
@@ -406,11 +412,11 @@ class PacmanRules:
 
         # Update Configuration
         vector = Actions.direction_to_vector(action, PacmanRules.PACMAN_SPEED)
-        pacman_st.configuration = pacman_st.configuration.generate_successor(
-            vector)
+        state.data.set_agent_configuration(
+            0, pacman_st.configuration.generate_successor(vector))
 
         # Eat
-        next_st = pacman_st.configuration.get_position()
+        next_st = state.data.agent_states[0].configuration.get_position()
         nearest = nearest_point(next_st)
         if manhattan_distance(nearest, next_st) <= 0.5:
             # Remove food
@@ -423,9 +429,7 @@ class PacmanRules:
         # Eat food
         if state.data.food[_x][_y]:
             state.data.score_change += 10
-            state.data.food = state.data.food.copy()
-            state.data.food[_x][_y] = False
-            state.data.food_eaten = position
+            state.data.remove_food(position)
             # TODO: cache num_food?
             num_food = state.get_num_food()
             if num_food == 0 and not state.data.lose:
@@ -433,11 +437,10 @@ class PacmanRules:
                 state.data.win = True
         # Eat capsule
         if position in state.get_capsules():
-            state.data.capsules.remove(position)
-            state.data.capsule_eaten = position
+            state.data.remove_capsule(position)
             # Reset all ghosts' scared timers
             for index in range(1, len(state.data.agent_states)):
-                state.data.agent_states[index].scared_timer = SCARED_TIME
+                state.data.set_scared_timer(index, SCARED_TIME)
 
 
 class LayoutNotFound(Exception):
@@ -457,19 +460,13 @@ class GhostRules:
         reach a dead end, but can turn 90 degrees at intersections.
         """
         conf = state.get_ghost_state(ghost_index).configuration
-        possible_actions = Actions.get_possible_actions(
-            conf, state.data.layout.walls)
-        reverse = Actions.reverse_direction(conf.direction)
-        if Directions.STOP in possible_actions:
-            possible_actions.remove(Directions.STOP)
-        if reverse in possible_actions and len(possible_actions) > 1:
-            possible_actions.remove(reverse)
-        return possible_actions
+        return list(state.data.layout.legal_actions.get_ghost_actions(conf))
 
     @staticmethod
     def apply_action(state, action, ghost_index):
         " Apply an Action "
-        legal = GhostRules.get_legal_actions(state, ghost_index)
+        legal = state.data.layout.legal_actions.get_ghost_actions(
+            state.data.agent_states[ghost_index].configuration)
         if action not in legal:
             raise UserWarning("Illegal ghost action " + str(action))
 
@@ -478,17 +475,20 @@ class GhostRules:
         if ghost_state.scared_timer > 0:
             speed /= 2.0
         vector = Actions.direction_to_vector(action, speed)
-        ghost_state.configuration = \
-            ghost_state.configuration.generate_successor(vector)
+        state.data.set_agent_configuration(
+            ghost_index, ghost_state.configuration.generate_successor(vector))
 
     @staticmethod
-    def decrement_timer(ghost_state):
+    def decrement_timer(state, ghost_index):
         " Decrease the Timer "
+        ghost_state = state.data.agent_states[ghost_index]
         timer = ghost_state.scared_timer
         if timer == 1:
-            ghost_state.configuration.pos = nearest_point(
-                ghost_state.configuration.pos)
-        ghost_state.scared_timer = max(0, timer - 1)
+            configuration = ghost_state.configuration
+            state.data.set_agent_configuration(
+                ghost_index, Configuration(nearest_point(configuration.pos),
+                                           configuration.direction))
+        state.data.set_scared_timer(ghost_index, max(0, timer - 1))
 
     @staticmethod
     def check_death(state, agent_index):
@@ -511,8 +511,8 @@ class GhostRules:
         " Check Collision "
         if ghost_state.scared_timer > 0:
             state.data.score_change += 200
-            GhostRules.place_ghost(state, ghost_state)
-            ghost_state.scared_timer = 0
+            GhostRules.place_ghost(state, agent_index)
+            state.data.set_scared_timer(agent_index, 0)
             # Added for first-person
             state.data._eaten[agent_index] = True
         else:
@@ -527,9 +527,10 @@ class GhostRules:
                                   pacman_position) <= COLLISION_TOLERANCE
 
     @staticmethod
-    def place_ghost(ghost_state):
+    def place_ghost(state, ghost_index):
         " Placing the Ghost "
-        ghost_state.configuration = ghost_state.start
+        ghost_state = state.data.agent_states[ghost_index]
+        state.data.set_agent_configuration(ghost_index, ghost_state.start)
 
 #############################
 # FRAMEWORK TO START A GAME #
@@ -644,6 +645,29 @@ def read_command(argv):
                       type='int',
                       help=default("""Maximum length of time an agent can spend
                                    computing in a single game"""), default=30)
+    parser.add_option('--move_timeout_ms',
+                      dest='move_timeout_ms',
+                      type='float',
+                      help=default("""Maximum milliseconds an agent can spend
+                                   on a single move with -c (defaults to
+                                   the game timeout)"""), default=None)
+    parser.add_option('--visit_tracker',
+                      dest='visit_tracker',
+                      type='choice',
+                      choices=VISIT_TRACKERS,
+                      help=default("""How to track visited states: off, exact
+                                   (capped set), bloom or hll (distinct
+                                   count)"""), default='exact')
+    parser.add_option('--visit_capacity',
+                      dest='visit_capacity',
+                      type='int',
+                      help=default("""Capacity of the exact or bloom visit
+                                   tracker"""), default=100000)
+    parser.add_option('--track_training_visits',
+                      action='store_true',
+                      dest='track_training_visits',
+                      help="""Also track visited states during training
+                              games""", default=False)
 
     options, otherjunk = parser.parse_args(argv)
     if len(otherjunk) != 0:
@@ -700,6 +724,10 @@ def read_command(argv):
     args['record'] = options.record
     args['catch_exceptions'] = options.catch_exceptions
     args['timeout'] = options.timeout
+    args['move_timeout_ms'] = options.move_timeout_ms
+    args['visit_tracker'] = options.visit_tracker
+    args['visit_capacity'] = options.visit_capacity
+    args['track_training_visits'] = options.track_training_visits
 
     # Special case: recorded games don't use the run_games method or args
     # structure
@@ -768,12 +796,15 @@ def replay_game(layout, actions, display):
 def run_games(layout, pacman, ghosts,
               display, num_games, record,
               num_training=0, catch_exceptions=False,
-              timeout=30):
+              timeout=30, visit_tracker='exact', visit_capacity=100000,
+              track_training_visits=False, move_timeout_ms=None):
     " Inititalize Game "
     __main__.__dict__['_display'] = display
 
-    rules = ClassicGameRules(timeout)
+    move_timeout = None if move_timeout_ms is None else move_timeout_ms / 1000
+    rules = ClassicGameRules(timeout, move_timeout)
     games = []
+    tracker = make_visit_tracker(visit_tracker, visit_capacity)
 
     for i in range(num_games):
         be_quiet = i < num_training
@@ -784,8 +815,13 @@ def run_games(layout, pacman, ghosts,
         else:
             game_display = display
             rules.quiet = False
+        if be_quiet and not track_training_visits:
+            GameState.explored = None
+        else:
+            GameState.explored = tracker
         game = rules.new_game(layout, pacman, ghosts,
                               game_display, be_quiet, catch_exceptions)
+        game.record_history = record
         game.run()
 
         if not be_quiet:
@@ -807,6 +843,8 @@ def run_games(layout, pacman, ghosts,
         print(f"Win Rate: {wins.count(True)}/{len(wins)} ({win_rate})")
         print('Record:       ', ', '.join(
             [['Loss', 'Win'][int(w)] for w in wins]))
+        if tracker is not None:
+            print('States Visited:', len(tracker))
         end_time = time.time()
         print(f"Execution Time = {end_time - start_time}s")
 
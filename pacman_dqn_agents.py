@@ -10,32 +10,57 @@ pacman_dqn_agents.py
 
 """
 from collections import deque
+import json
+import os
+import random
+import shutil
 import time
 import sys
-import random
 import numpy as np
 
-import tensorflow.compat.v1 as tf
-import deep_q_network
-from pacman import Directions
+import numpy_q_network
+from replay_memory import ReplayMemory, PrioritizedReplayMemory
+from replay_memory import MinibatchPrefetcher
+from game import Directions
 import game
 
 params = {
     # Model backups
     'load_file': None,
     'save_file': None,
+    # Weights exported by numpy_q_network to only play from, without
+    # TensorFlow or training
+    'weights_file': None,
     'save_interval': 10000,
+    'keep_states': 1,       # Training state snapshots kept (0 keeps all)
 
     # Training parameters
     'train_start': 5000,    # Episodes before training starts
     'batch_size': 32,       # Replay memory batch size
     'mem_size': 100000,     # Replay memory size
+    'replay_dir': None,     # Directory to memory-map replay into, or None
+    'prefetch': 0,          # Minibatches assembled ahead in a thread, or 0
+
+    # Prioritized replay
+    'prioritized': False,       # Sample transitions by TD error
+    'priority_alpha': 0.6,      # Priority exponent (0 is uniform)
+    'priority_beta': 0.4,       # Importance-sampling exponent start value
+    'priority_beta_step': 100000,   # Steps to anneal beta to 1 (linear)
 
+    'target_update': 0,     # Updates between target network syncs, or 0
+                            # to bootstrap from the network being trained
     'discount': 0.95,       # Discount rate (gamma value)
     'lr': .0002,            # Learning reate
     # 'rms_decay': 0.99,      # RMS Prop decay (switched to adam)
     # 'rms_eps': 1e-6,        # RMS Prop epsilon (switched to adam)
 
+    # Process and TensorFlow session resources
+    'cpu_affinity': None,       # CPUs to pin the agent's process to
+    'intra_op_threads': 0,      # Threads within one op (0: one per core)
+    'inter_op_threads': 0,      # Ops run in parallel (0: one per core)
+    'graph_opt_level': 'L1',    # Graph optimizer level, 'L0' to disable
+    'xla_jit': False,           # Compile the graph with XLA
+
     # Epsilon value (epsilon-greederi_y)
     'eps': 1.0,             # Epsilon start value
     'eps_final': 0.1,       # Epsilon end value
@@ -43,6 +68,88 @@ params = {
 }
 
 
+def agent_cells(data):
+    """ Return the (x, y, plane) cell marked for each agent of a
+    GameStateData: pacman, ghost or scared ghost """
+    cells = []
+    for agent_state in data.agent_states:
+        x, y = agent_state.configuration.get_position()
+        if agent_state.is_pac:
+            plane = 1
+        elif agent_state.scared_timer > 0:
+            plane = 3
+        else:
+            plane = 2
+        cells.append((int(x), int(y), plane))
+    return cells
+
+
+class ObservationEncoder:
+    """
+    Incremental version of a full observation encoder such as
+    PacmanDQN.get_state_matrices. reset(state) encodes a state in full;
+    update(state) derives the observation of the next state of the same
+    game from the previous one by applying only the cells that changed.
+
+    Agents are re-marked only if one of them moved or flipped between the
+    ghost and scared ghost planes. Pellets and capsules are only eaten
+    under pacman, and the food grid and capsule list are copied on write,
+    so they are only looked at when those objects changed, and then only
+    at pacman's cell and the recorded food_eaten / capsule_eaten cells.
+    The observation is updated in place, so a caller that needs it after
+    the next update has to copy it; PacmanDQN packs it into replay memory
+    straight away.
+    """
+
+    def __init__(self, encode):
+        self.encode = encode
+        self.observation = None
+        self.layout = None
+        self.food = None
+        self.capsules = None
+        self.agent_cells = None
+
+    def reset(self, state):
+        """ Encode state from scratch """
+        self.observation = self.encode(state)
+        self.remember(state.data, agent_cells(state.data))
+        return self.observation
+
+    def remember(self, data, cells):
+        """ Record what the current observation was built from """
+        self.layout = data.layout
+        self.food = data.food
+        self.capsules = data.capsules
+        self.agent_cells = cells
+
+    def update(self, state):
+        """ Update and return the observation of state, the successor (one
+        or more moves later) of the state last encoded """
+        data = state.data
+        if self.observation is None or data.layout is not self.layout:
+            return self.reset(state)
+        height = data.layout.height
+        observation = self.observation
+
+        cells = agent_cells(data)
+        if cells != self.agent_cells:
+            for x, y, plane in self.agent_cells:
+                observation[x, height - 1 - y, plane] = 0
+            for x, y, plane in cells:
+                observation[x, height - 1 - y, plane] = 1
+
+        if data.food is not self.food or data.capsules is not self.capsules:
+            eaten = {cells[0][:2], data.food_eaten, data.capsule_eaten}
+            eaten.discard(None)
+            for x, y in eaten:
+                observation[x, height - 1 - y, 4] = data.food.data[x, y]
+                observation[x, height - 1 - y, 5] = (x, y) in data.capsules
+
+        self.observation = observation
+        self.remember(data, cells)
+        return observation
+
+
 class PacmanDQN(game.Agent):
     " Defining the PACMAN Agent "
     def __init__(self, args):
@@ -55,12 +162,25 @@ class PacmanDQN(game.Agent):
         self.params['height'] = args['height']
         self.params['num_training'] = args['num_training']
 
-        # Start Tensorflow session
-        gpu_options = tf.compat.v1.GPUOptions(
-            per_process_gpu_memory_fraction=0.1)
-        self.sess = tf.compat.v1.Session(
-            config=tf.compat.v1.ConfigProto(gpu_options=gpu_options))
-        self.qnet = deep_q_network.DQN(self.params)
+        # Pin before TensorFlow sizes its thread pools
+        if self.params['cpu_affinity'] is not None:
+            if not hasattr(os, 'sched_setaffinity'):
+                raise UserWarning(
+                    "CPU affinity is not supported on this platform")
+            os.sched_setaffinity(0, self.params['cpu_affinity'])
+
+        self.learning = self.params['weights_file'] is None
+        if self.learning:
+            # TensorFlow is only imported by agents that train
+            import deep_q_network
+            self.qnet = deep_q_network.DQN(self.params)
+        else:
+            self.qnet = numpy_q_network.NumpyQNetwork(
+                self.params['weights_file'])
+        # Input of greedy moves, filled in place with the current state
+        self.move_input = np.zeros(
+            (1, self.params['width'], self.params['height'], 6),
+            dtype=np.float32)
 
         # time started
         self.general_record_time = time.strftime("%a_%d_%b_%Y_%H_%M_%S",
@@ -68,7 +188,6 @@ class PacmanDQN(game.Agent):
         # Q and cost
         self.won = True
         self.q_global = []
-        self.q_pred = []
         self.terminal = None
         self.cost_disp = 0
 
@@ -77,12 +196,17 @@ class PacmanDQN(game.Agent):
         self.current_score = 0
 
         self.ep_rew = 0
-        self.last_state = None
         self.current_state = None
         self.last_action = None
+        self.walls_layout = None
+        self.walls_plane = None
+        self.encoder = ObservationEncoder(self.get_state_matrices)
 
         # Stats
-        self.cnt = self.qnet.sess.run(self.qnet.global_step)
+        if self.learning:
+            self.cnt = self.qnet.sess.run(self.qnet.global_step)
+        else:
+            self.cnt = self.qnet.global_step
         self.local_cnt = 0
 
         self.numeps = 0
@@ -90,34 +214,30 @@ class PacmanDQN(game.Agent):
         self._s = time.time()
         self.last_reward = 0.
 
-        self.replay_mem = deque()
+        self.replay_mem = None
+        if self.learning:
+            self.replay_mem = self.create_replay_memory(
+                self.params['replay_dir'])
         self.last_scores = deque()
+        self.prefetcher = None
+        # Training state snapshot directories on disk, oldest first
+        self.saved_states = deque()
+
+        load_file = self.params['load_file']
+        if self.learning and load_file is not None \
+                and os.path.isdir(load_file + '.state'):
+            print('Loading training state...')
+            self.load_training_state(load_file)
 
     def get_move(self):
         " get the next move "
         # Exploit / Explore
         if np.random.rand() > self.params['eps']:
             # Exploit action
-            self.q_pred = self.qnet.sess.run(
-                self.qnet._y,
-                feed_dict={self.qnet._x: np.reshape(self.current_state,
-                                                    (1, self.params['width'],
-                                                     self.params['height'],
-                                                     6)),
-                           self.qnet.q_t: np.zeros(1),
-                           self.qnet.actions: np.zeros((1, 4)),
-                           self.qnet.terminals: np.zeros(1),
-                           self.qnet.rewards: np.zeros(1)})[0]
-
-            self.q_global.append(max(self.q_pred))
-            awinner = np.argwhere(self.q_pred == np.amax(self.q_pred))
-
-            if len(awinner) > 1:
-                move = self.get_direction(
-                    awinner[np.random.randint(0, len(awinner))][0])
-            else:
-                move = self.get_direction(
-                    awinner[0][0])
+            self.move_input[0] = self.current_state
+            actions, max_q = self.qnet.greedy(self.move_input)
+            self.q_global.append(max_q[0])
+            move = self.get_direction(actions[0])
         else:
             # Random:
             move = self.get_direction(np.random.randint(0, 4))
@@ -151,8 +271,7 @@ class PacmanDQN(game.Agent):
         " Observation "
         if self.last_action is not None:
             # Process current experience state
-            self.last_state = np.copy(self.current_state)
-            self.current_state = self.get_state_matrices(state)
+            self.current_state = self.encoder.update(state)
 
             # Process current experience reward
             self.current_score = state.get_score()
@@ -173,28 +292,25 @@ class PacmanDQN(game.Agent):
                 self.last_reward = 100.
             self.ep_rew += self.last_reward
 
-            # Store last experience into memory
-            experience = (self.last_state,
-                          float(self.last_reward),
-                          self.last_action, self.current_state,
-                          self.terminal)
-            self.replay_mem.append(experience)
-            if len(self.replay_mem) > self.params['mem_size']:
-                self.replay_mem.popleft()
-
-            # Save model
-            if params['save_file']:
-                if (self.local_cnt > self.params['train_start']
-                   and self.local_cnt
-                   % self.params['save_interval'] == 0):
-                    self.qnet.save_ckpt('saves/model-'
-                                        + params['save_file'] + "_"
-                                        + str(self.cnt) + '_'
-                                        + str(self.numeps))
-                    print('Model saved')
-
-            # Train
-            self.train()
+            if self.learning:
+                # Store last experience into memory
+                self.replay_mem.add(self.last_action, self.last_reward,
+                                    self.current_state, self.terminal)
+
+                # Save model
+                if params['save_file']:
+                    if (self.local_cnt > self.params['train_start']
+                       and self.local_cnt
+                       % self.params['save_interval'] == 0):
+                        save_path = ('saves/model-' + params['save_file']
+                                     + "_" + str(self.cnt) + '_'
+                                     + str(self.numeps))
+                        self.qnet.save_ckpt(save_path)
+                        self.save_training_state(save_path)
+                        print('Model saved')
+
+                # Train
+                self.train()
 
         # Next
         self.local_cnt += 1
@@ -249,40 +365,112 @@ class PacmanDQN(game.Agent):
                 won: {self.won} \n""")
             sys.stdout.flush()
 
+    def create_replay_memory(self, directory):
+        """ Replay memory of the configured kind, memory-mapped in directory
+        unless it is None """
+        state_shape = (self.params['width'], self.params['height'], 6)
+        if self.params['prioritized']:
+            return PrioritizedReplayMemory(
+                self.params['mem_size'], state_shape, directory=directory,
+                alpha=self.params['priority_alpha'])
+        return ReplayMemory(self.params['mem_size'], state_shape,
+                            directory=directory)
+
+    def save_training_state(self, path):
+        """ Snapshot replay memory, counters, epsilon and random states in
+        path + '.state', next to the checkpoint at path. A memory-mapped
+        replay is only flushed and referred to, not copied """
+        directory = path + '.state'
+        if self.replay_mem.directory is None:
+            self.replay_mem.save(os.path.join(directory, 'replay'))
+            replay = None
+        else:
+            os.makedirs(directory, exist_ok=True)
+            with self.replay_mem.lock:
+                self.replay_mem.flush()
+                replay = {'directory': self.replay_mem.directory,
+                          'meta': self.replay_mem.describe()}
+        name, keys, pos, has_gauss, gauss = np.random.get_state()
+        state = {'replay': replay,
+                 'numeps': self.numeps,
+                 'local_cnt': self.local_cnt,
+                 'eps': self.params['eps'],
+                 'last_scores': list(self.last_scores),
+                 'random_state': random.getstate(),
+                 'np_random_state': [name, keys.tolist(), pos, has_gauss,
+                                     gauss]}
+        with open(os.path.join(directory, 'agent.json'), 'w',
+                  encoding='utf-8') as state_file:
+            json.dump(state, state_file)
+
+        # Snapshots of in-memory replays hold a full copy of it, so only
+        # the latest are kept
+        self.saved_states.append(directory)
+        while (self.params['keep_states']
+               and len(self.saved_states) > self.params['keep_states']):
+            shutil.rmtree(self.saved_states.popleft(), ignore_errors=True)
+
+    def load_training_state(self, path):
+        """ Restore what save_training_state wrote for the checkpoint at
+        path """
+        directory = path + '.state'
+        with open(os.path.join(directory, 'agent.json'),
+                  encoding='utf-8') as state_file:
+            state = json.load(state_file)
+        replay = state.get('replay')
+        if replay is None:
+            self.replay_mem.load(os.path.join(directory, 'replay'))
+        else:
+            # The memory-mapped replay carries on from where it stands,
+            # which is at or after where it stood at the checkpoint
+            if replay['directory'] != self.replay_mem.directory:
+                self.replay_mem = self.create_replay_memory(
+                    replay['directory'])
+            if self.replay_mem.written < replay['meta']['written']:
+                raise ValueError("Replay memory in " + replay['directory']
+                                 + " is older than the checkpoint at "
+                                 + path)
+        self.numeps = state['numeps']
+        self.local_cnt = state['local_cnt']
+        self.params['eps'] = state['eps']
+        self.last_scores = deque(state['last_scores'])
+        version, internal, gauss = state['random_state']
+        random.setstate((version, tuple(internal), gauss))
+        name, keys, pos, has_gauss, gauss = state['np_random_state']
+        np.random.set_state((name, np.array(keys, np.uint32), pos,
+                             has_gauss, gauss))
+        self.saved_states.append(directory)
+
     def train(self):
         " Train "
         if self.local_cnt > self.params['train_start']:
-            batch = random.sample(self.replay_mem, self.params['batch_size'])
-            batch_s = []  # States (_s)
-            batch_r = []  # Rewards (r)
-            batch_a = []  # Actions (a)
-            batch_n = []  # Next states (_s')
-            batch_t = []  # Terminal state (t)
-
-            for i in batch:
-                batch_s.append(i[0])
-                batch_r.append(i[1])
-                batch_a.append(i[2])
-                batch_n.append(i[3])
-                batch_t.append(i[4])
-            batch_s = np.array(batch_s)
-            batch_r = np.array(batch_r)
-            batch_a = self.get_onehot(np.array(batch_a))
-            batch_n = np.array(batch_n)
-            batch_t = np.array(batch_t)
-
-            self.cnt, self.cost_disp = self.qnet.train(batch_s,
-                                                       batch_a,
-                                                       batch_t,
-                                                       batch_n,
-                                                       batch_r)
-
-    def get_onehot(self, actions):
-        """ Create list of vectors with 1 values at index of action in list """
-        actions_onehot = np.zeros((self.params['batch_size'], 4))
-        for i, _ in enumerate(actions):
-            actions_onehot[i][int(actions[i])] = 1
-        return actions_onehot
+            beta = None
+            if self.params['prioritized']:
+                beta = min(1., self.params['priority_beta']
+                           + (1. - self.params['priority_beta'])
+                           * float(self.cnt)
+                           / float(self.params['priority_beta_step']))
+
+            if self.params['prefetch']:
+                if self.prefetcher is None:
+                    self.prefetcher = MinibatchPrefetcher(
+                        self.replay_mem, self.params['batch_size'],
+                        self.params['prefetch'],
+                        seed=np.random.randint(2 ** 31), beta=beta)
+                self.prefetcher.beta = beta
+                indices, serials, batch, weights = self.prefetcher.get()
+            else:
+                indices, serials, batch, weights = self.replay_mem.draw(
+                    self.params['batch_size'], beta=beta)
+            batch_s, batch_a, batch_t, batch_n, batch_r, batch_w = batch
+
+            self.cnt, self.cost_disp, td_errors = self.qnet.train(
+                batch_s, batch_a, batch_t, batch_n, batch_r, batch_w,
+                weights)
+
+            if self.params['prioritized']:
+                self.replay_mem.update_priorities(indices, serials,
+                                                  td_errors)
 
     def merge_state_matrices(self, state_matrices):
         """ Merge state matrices to one state tensor """
@@ -292,102 +480,28 @@ class PacmanDQN(game.Agent):
             total += (i + 1) * state_matrices[i] / 6
         return total
 
-    def get_state_matrices(self, state):
-        """ Return wall, ghosts, food, capsules matrices """
-        def get_wall_matrix(state):
-            """ Return matrix with wall coordinates set to 1 """
-            width, height = state.data.layout.width, state.data.layout.height
-            grid = state.data.layout.walls
-            matrix = np.zeros((height, width), dtype=np.int8)
-            for i in range(grid.height):
-                for j in range(grid.width):
-                    # Put cell vertically reversed in matrix
-                    cell = 1 if grid[j][i] else 0
-                    matrix[-1-i][j] = cell
-            return matrix
-
-        def get_pacman_matrix(state):
-            """ Return matrix with pacman coordinates set to 1 """
-            width, height = state.data.layout.width, state.data.layout.height
-            matrix = np.zeros((height, width), dtype=np.int8)
-
-            for agent_state in state.data.agent_states:
-                if agent_state.is_pac:
-                    pos = agent_state.configuration.get_position()
-                    cell = 1
-                    matrix[-1-int(pos[1])][int(pos[0])] = cell
-
-            return matrix
-
-        def get_ghost_matrix(state):
-            """ Return matrix with ghost coordinates set to 1 """
-            width, height = state.data.layout.width, state.data.layout.height
-            matrix = np.zeros((height, width), dtype=np.int8)
-
-            for agent_state in state.data.agent_states:
-                if not agent_state.is_pac:
-                    if not agent_state.scared_timer > 0:
-                        pos = agent_state.configuration.get_position()
-                        cell = 1
-                        matrix[-1-int(pos[1])][int(pos[0])] = cell
-
-            return matrix
-
-        def get_scared_ghost_matrix(state):
-            """ Return matrix with ghost coordinates set to 1 """
-            width, height = state.data.layout.width, state.data.layout.height
-            matrix = np.zeros((height, width), dtype=np.int8)
-
-            for agent_state in state.data.agent_states:
-                if not agent_state.is_pac:
-                    if agent_state.scared_timer > 0:
-                        pos = agent_state.configuration.get_position()
-                        cell = 1
-                        matrix[-1-int(pos[1])][int(pos[0])] = cell
-
-            return matrix
-
-        def get_food_matrix(state):
-            """ Return matrix with food coordinates set to 1 """
-            width, height = state.data.layout.width, state.data.layout.height
-            grid = state.data.food
-            matrix = np.zeros((height, width), dtype=np.int8)
-
-            for i in range(grid.height):
-                for j in range(grid.width):
-                    # Put cell vertically reversed in matrix
-                    cell = 1 if grid[j][i] else 0
-                    matrix[-1-i][j] = cell
-
-            return matrix
-
-        def get_capsules_matrix(state):
-            """ Return matrix with capsule coordinates set to 1 """
-            width, height = state.data.layout.width, state.data.layout.height
-            capsules = state.data.layout.capsules
-            matrix = np.zeros((height, width), dtype=np.int8)
-
-            for i in capsules:
-                # Insert capsule cells vertically reversed into matrix
-                matrix[-1-i[1], i[0]] = 1
-
-            return matrix
-
-        # Create observation matrix as a combination of
-        # wall, pacman, ghost, food and capsule matrices
-        # width, height = state.data.layout.width, state.data.layout.height
-        width, height = self.params['width'], self.params['height']
-        observation = np.zeros((6, height, width))
-
-        observation[0] = get_wall_matrix(state)
-        observation[1] = get_pacman_matrix(state)
-        observation[2] = get_ghost_matrix(state)
-        observation[3] = get_scared_ghost_matrix(state)
-        observation[4] = get_food_matrix(state)
-        observation[5] = get_capsules_matrix(state)
-
-        observation = np.swapaxes(observation, 0, 2)
+    def get_walls_plane(self, layout):
+        """ Return the vertically reversed walls plane of a layout,
+        computed once per layout and reused """
+        if layout is not self.walls_layout:
+            self.walls_layout = layout
+            self.walls_plane = layout.walls.data[:, ::-1].astype(np.float32)
+        return self.walls_plane
 
+    def get_state_matrices(self, state):
+        """ Return the (width, height, 6) float32 observation whose planes
+        are walls, pacman, ghosts, scared ghosts, food and capsules, with
+        rows vertically reversed """
+        data = state.data
+        width, height = data.layout.width, data.layout.height
+        observation = np.zeros((width, height, 6), dtype=np.float32)
+        observation[:, :, 0] = self.get_walls_plane(data.layout)
+        observation[:, :, 4] = data.food.data[:, ::-1]
+
+        # Agents and capsules are marked in a single scatter
+        cells = [(x, y, 5) for x, y in data.capsules] + agent_cells(data)
+        cell_x, cell_y, planes = np.array(cells, dtype=np.intp).T
+        observation[cell_x, height - 1 - cell_y, planes] = 1
         return observation
 
     def register_initial_state(self, state):
@@ -400,8 +514,9 @@ class PacmanDQN(game.Agent):
         self.ep_rew = 0
 
         # Reset state
-        self.last_state = None
-        self.current_state = self.get_state_matrices(state)
+        self.current_state = self.encoder.reset(state)
+        if self.learning:
+            self.replay_mem.start_episode(self.current_state)
 
         # Reset actions
         self.last_action = None
@@ -0,0 +1,306 @@
+"""
+pacman_env.py
+# ------------
+Environments that drive the classic Pacman rules from an external training
+loop instead of through Game.run.
+
+PacmanEnv wraps one game created by ClassicGameRules.new_game behind
+reset() and step(action): the caller plays Pacman, the ghost agents' turns
+are resolved inside step(), and no state is deep-copied for callbacks.
+
+BatchPacmanEnv holds N independent games on one layout as stacked NumPy
+arrays and advances all of them with a single step() call: Pacman actions
+come from the caller, random ghosts are sampled in bulk, and observations
+come back in the (width, height, 6) plane layout used by PacmanDQN.
+"""
+import numpy as np
+
+import fast_pacman
+from fast_pacman import DIRECTIONS, STOP, KILL_DISTANCE, start_positions
+from pacman import ClassicGameRules
+from pacman import SCARED_TIME, TIME_PENALTY
+from text_display import NullGraphics
+
+# fast_pacman's movement per direction index, as arrays to index in bulk
+DELTA_X = np.array(fast_pacman.DELTA_X, dtype=np.int32)
+DELTA_Y = np.array(fast_pacman.DELTA_Y, dtype=np.int32)
+
+# Observation planes, as produced by PacmanDQN.get_state_matrices
+WALLS, PACMAN, GHOSTS, SCARED_GHOSTS, FOOD, CAPSULES = range(6)
+NUM_PLANES = 6
+
+
+class PacmanEnv:
+    """
+    One game of classic Pacman with inverted control.
+
+    reset() starts a game and step(action) plays Pacman's move followed by
+    every ghost's move, returning (observation, reward, done, info). The
+    observation is the GameState itself (successor states are never
+    modified, so it is safe to keep) or encoder(state) when an encoder is
+    given. The reward is the change in score over the round.
+    """
+
+    def __init__(self, layout, ghosts, display=None, rules=None,
+                 encoder=None):
+        self.layout = layout
+        self.ghosts = ghosts
+        self.display = display if display is not None else NullGraphics()
+        self.rules = rules if rules is not None else ClassicGameRules()
+        self.encoder = encoder
+        self.game = None
+        self.state = None
+
+    def reset(self):
+        """Starts a new game and returns its first observation"""
+        self.game = self.rules.new_game(self.layout, None, self.ghosts,
+                                        self.display, quiet=True)
+        self.state = self.game.state
+        for agent in self.game.agents[1:]:
+            if hasattr(agent, 'register_initial_state'):
+                agent.register_initial_state(self.state)
+        self.display.initialize(self.state.data)
+        return self.observe()
+
+    def step(self, action):
+        """
+        Plays Pacman's action, then the ghosts' replies. Raises UserWarning
+        for an illegal action or when the game is already over.
+        """
+        if self.game is None or self.game.game_over:
+            raise UserWarning("Call reset() before stepping a finished game")
+        start_score = self.state.data.score
+        agent_index = 0
+        while True:
+            self._advance(agent_index, action)
+            agent_index += 1
+            if self.game.game_over or agent_index == len(self.game.agents):
+                break
+            action = self.game.agents[agent_index].get_action(self.state)
+        info = {'score': self.state.get_score(),
+                'win': self.state.iswin(),
+                'lose': self.state.islose()}
+        reward = self.state.data.score - start_score
+        return self.observe(), reward, self.game.game_over, info
+
+    def _advance(self, agent_index, action):
+        self.game.move_history.append((agent_index, action))
+        self.state = self.state.generate_successor(agent_index, action)
+        self.game.state = self.state
+        self.display.update(self.state.data)
+        self.rules.process(self.state, self.game)
+
+    def get_legal_actions(self):
+        """Pacman's legal actions in the current state"""
+        return self.state.get_legal_actions(0)
+
+    def observe(self):
+        """The current observation"""
+        if self.encoder is None:
+            return self.state
+        return self.encoder(self.state)
+
+
+def _bit_tables():
+    """Popcount and position of the r-th set bit for 5-bit action masks"""
+    counts = np.zeros(1 << len(DIRECTIONS), dtype=np.int32)
+    nth_bit = np.full((1 << len(DIRECTIONS), len(DIRECTIONS)), STOP,
+                      dtype=np.int32)
+    for mask in range(1 << len(DIRECTIONS)):
+        bits = [bit for bit in range(len(DIRECTIONS)) if mask & (1 << bit)]
+        counts[mask] = len(bits)
+        nth_bit[mask, :len(bits)] = bits
+    return counts, nth_bit
+
+
+MASK_COUNTS, MASK_NTH_BIT = _bit_tables()
+
+
+class BatchPacmanEnv:
+    """
+    N games of classic Pacman against random ghosts, stepped together.
+
+    Positions are kept in half-cell units so half-speed scared ghosts stay
+    integral. Actions are indices into LegalActionTable.DIRECTIONS; an
+    illegal Pacman action is replaced by Stop, as PacmanDQN.get_action does.
+    Games that end are reset automatically: step() reports their reward and
+    done flag, final score and outcome in info, and returns the first
+    observation of the new game in their slot.
+    """
+
+    def __init__(self, layout, num_games, num_ghosts=None, seed=None):
+        self.layout = layout
+        self.num_games = num_games
+        self.width, self.height = layout.width, layout.height
+        self.rng = np.random.default_rng(seed)
+
+        if num_ghosts is None:
+            num_ghosts = layout.get_num_ghosts()
+        starts = start_positions(layout, num_ghosts)
+        self.num_agents = len(starts)
+        self.start_x = np.array([x_pos for x_pos, _ in starts], np.int32)
+        self.start_y = np.array([y_pos for _, y_pos in starts], np.int32)
+
+        # Legal action bitmasks per cell, and per cell and heading for ghosts
+        table = layout.legal_actions
+        self.pacman_masks = np.zeros((self.width, self.height), np.int32)
+        self.ghost_masks = np.zeros(
+            (self.width, self.height, len(DIRECTIONS)), np.int32)
+        for (x_pos, y_pos), mask in table.masks.items():
+            self.pacman_masks[x_pos, y_pos] = mask
+            for heading, direction in enumerate(DIRECTIONS):
+                for action in table.ghost_actions[((x_pos, y_pos),
+                                                   direction)]:
+                    self.ghost_masks[x_pos, y_pos, heading] |= \
+                        1 << DIRECTIONS.index(action)
+
+        self.initial_food = layout.food.data.copy()
+        self.initial_capsules = np.zeros((self.width, self.height), bool)
+        for x_pos, y_pos in layout.capsules:
+            self.initial_capsules[x_pos, y_pos] = True
+        # Planes are indexed [x, height - 1 - y], like get_state_matrices
+        self.walls_plane = layout.walls.data[:, ::-1].astype(np.float32)
+
+        shape = (num_games, self.num_agents)
+        self.x_pos = np.zeros(shape, np.int32)
+        self.y_pos = np.zeros(shape, np.int32)
+        self.heading = np.zeros(shape, np.int32)
+        self.scared = np.zeros(shape, np.int32)
+        self.food = np.zeros((num_games, self.width, self.height), bool)
+        self.capsules = np.zeros_like(self.food)
+        self.num_food = np.zeros(num_games, np.int32)
+        self.score = np.zeros(num_games, np.int32)
+        self.win = np.zeros(num_games, bool)
+        self.lose = np.zeros(num_games, bool)
+        self.reset()
+
+    def reset(self):
+        """Restarts every game and returns the stacked observations"""
+        self._reset_games(np.ones(self.num_games, bool))
+        return self.observe()
+
+    def _reset_games(self, games):
+        self.x_pos[games] = self.start_x
+        self.y_pos[games] = self.start_y
+        self.heading[games] = STOP
+        self.scared[games] = 0
+        self.food[games] = self.initial_food
+        self.capsules[games] = self.initial_capsules
+        self.num_food[games] = np.count_nonzero(self.initial_food)
+        self.score[games] = 0
+        self.win[games] = False
+        self.lose[games] = False
+
+    def step(self, actions):
+        """
+        Plays one round in every game: Pacman takes actions[i] in game i,
+        then each ghost still in play moves at random.
+
+        Returns (observations, rewards, dones, info) where rewards are score
+        changes over the round and info holds the final 'score' and 'win'
+        arrays (meaningful where done).
+        """
+        games = np.arange(self.num_games)
+        actions = np.asarray(actions, dtype=np.int32)
+        score_change = np.full(self.num_games, -TIME_PENALTY, np.int32)
+
+        # Pacman
+        cell_x, cell_y = self.x_pos[:, 0] >> 1, self.y_pos[:, 0] >> 1
+        legal = (self.pacman_masks[cell_x, cell_y] >> actions) & 1
+        actions = np.where(legal == 1, actions, STOP)
+        self.x_pos[:, 0] += DELTA_X[actions]
+        self.y_pos[:, 0] += DELTA_Y[actions]
+        self.heading[:, 0] = np.where(actions != STOP, actions,
+                                      self.heading[:, 0])
+        cell_x, cell_y = self.x_pos[:, 0] >> 1, self.y_pos[:, 0] >> 1
+
+        eaten = self.food[games, cell_x, cell_y]
+        self.food[games, cell_x, cell_y] = False
+        self.num_food -= eaten
+        score_change += 10 * eaten
+        cleared = eaten & (self.num_food == 0)
+        score_change += 500 * cleared
+        self.win |= cleared
+
+        capsule = self.capsules[games, cell_x, cell_y]
+        self.capsules[games, cell_x, cell_y] = False
+        self.scared[capsule, 1:] = SCARED_TIME
+
+        # Pacman meets every ghost, even after winning or losing on the move
+        for ghost in range(1, self.num_agents):
+            score_change += self._check_death(ghost, games >= 0)
+
+        # Ghosts
+        for ghost in range(1, self.num_agents):
+            playing = ~(self.win | self.lose)
+            self._move_ghost(ghost, playing)
+            score_change += self._check_death(ghost, playing)
+
+        self.score += score_change
+        dones = self.win | self.lose
+        info = {'score': self.score.copy(), 'win': self.win.copy()}
+        if dones.any():
+            self._reset_games(dones)
+        return self.observe(), score_change, dones, info
+
+    def _move_ghost(self, ghost, playing):
+        x_pos, y_pos = self.x_pos[:, ghost], self.y_pos[:, ghost]
+        heading, scared = self.heading[:, ghost], self.scared[:, ghost]
+        on_grid = ((x_pos | y_pos) & 1) == 0
+        masks = np.where(
+            on_grid,
+            self.ghost_masks[x_pos >> 1, y_pos >> 1, heading],
+            1 << heading)
+        actions = self._sample_actions(masks)
+
+        # Scared ghosts move at half speed
+        half_speed = (scared > 0).astype(np.int32)
+        new_x = x_pos + (DELTA_X[actions] >> half_speed)
+        new_y = y_pos + (DELTA_Y[actions] >> half_speed)
+        # Snap back onto the grid as a ghost stops being scared
+        snap = scared == 1
+        new_x = np.where(snap, 2 * ((new_x + 1) >> 1), new_x)
+        new_y = np.where(snap, 2 * ((new_y + 1) >> 1), new_y)
+
+        self.x_pos[:, ghost] = np.where(playing, new_x, x_pos)
+        self.y_pos[:, ghost] = np.where(playing, new_y, y_pos)
+        self.heading[:, ghost] = np.where(playing & (actions != STOP),
+                                          actions, heading)
+        self.scared[:, ghost] = np.where(playing, np.maximum(scared - 1, 0),
+                                         scared)
+
+    def _sample_actions(self, masks):
+        """Picks one set bit of each action mask uniformly at random"""
+        counts = MASK_COUNTS[masks]
+        picks = (self.rng.random(masks.shape) * counts).astype(np.int32)
+        return MASK_NTH_BIT[masks, picks]
+
+    def _check_death(self, ghost, playing):
+        distance = (np.abs(self.x_pos[:, ghost] - self.x_pos[:, 0])
+                    + np.abs(self.y_pos[:, ghost] - self.y_pos[:, 0]))
+        hit = playing & (distance <= KILL_DISTANCE)
+        eaten = hit & (self.scared[:, ghost] > 0)
+        self.x_pos[eaten, ghost] = self.start_x[ghost]
+        self.y_pos[eaten, ghost] = self.start_y[ghost]
+        self.heading[eaten, ghost] = STOP
+        self.scared[eaten, ghost] = 0
+        killed = hit & ~eaten & ~self.win
+        self.lose |= killed
+        return 200 * eaten - 500 * killed
+
+    def observe(self):
+        """Stacked (num_games, width, height, 6) float32 observations"""
+        observation = np.zeros(
+            (self.num_games, self.width, self.height, NUM_PLANES),
+            np.float32)
+        observation[..., WALLS] = self.walls_plane
+        observation[..., FOOD] = self.food[:, :, ::-1]
+        observation[..., CAPSULES] = self.capsules[:, :, ::-1]
+
+        games = np.repeat(np.arange(self.num_games), self.num_agents)
+        cell_x = (self.x_pos >> 1).reshape(-1)
+        cell_y = self.height - 1 - (self.y_pos >> 1).reshape(-1)
+        planes = np.where(self.scared > 0, SCARED_GHOSTS, GHOSTS)
+        planes[:, 0] = PACMAN
+        observation[games, cell_x, cell_y, planes.reshape(-1)] = 1
+        return observation
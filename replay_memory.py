@@ -0,0 +1,505 @@
+"""
+replay_memory.py
+# ---------------
+Experience replay for PacmanDQN.
+
+ReplayMemory preallocates contiguous arrays for observations (frames),
+actions, rewards and terminal flags and writes into them circularly,
+overwriting the oldest entries once capacity is reached. Each frame is
+stored once: the transition in slot i goes from frame i to frame i + 1,
+and the last frame of an episode, which has no transition of its own, is
+never sampled. A minibatch is a vector of random slots gathered from every
+array with one fancy-index operation each.
+
+The walls plane is the same for every frame of a layout, so frames only
+keep the dynamic planes, bit-packed, plus the index of their layout's walls
+plane. They are only expanded back to float32 when a minibatch is
+gathered, and the walls come back once per layout for the graph to
+broadcast over the batch.
+
+Given a directory, the arrays are memory-mapped .npy files in it, so
+capacity is bounded by disk rather than RAM and the OS page cache does the
+buffering. A small replay.json next to them records where writing had got
+to; it is rewritten at every episode boundary and by flush. A memory
+opened on a directory holding a replay of the same shape carries on from
+it instead of starting empty, dropping whatever was added after
+replay.json was last written. The arrays themselves only reach the disk
+when the OS writes the pages back or flush is called, so only flushed
+contents are sure to survive the machine (rather than the process)
+going down.
+
+MinibatchPrefetcher assembles minibatches ahead of time in a background
+thread and hands them over through a bounded queue.
+"""
+import json
+import os
+import queue
+import threading
+import numpy as np
+
+NUM_ACTIONS = 4
+WALLS = 0
+SNAPSHOT_CHUNK = 1 << 20    # slots copied at a time by save and load
+
+# Float32 bits of every byte value, little endian, so unpacking is a gather
+UNPACKED_BYTES = np.unpackbits(np.arange(256, dtype=np.uint8)[:, np.newaxis],
+                               axis=1, bitorder='little').astype(np.float32)
+
+
+def pack_planes(observation):
+    """ Pack a binary observation into a flat array of bits """
+    return np.packbits(observation.astype(np.bool_), axis=None,
+                       bitorder='little')
+
+
+def unpack_planes(packed, shape):
+    """ Expand a batch of pack_planes outputs into float32 observations of
+    the given shape """
+    bits = UNPACKED_BYTES.take(packed, axis=0).reshape(len(packed), -1)
+    return bits[:, :np.prod(shape)].reshape((len(packed),) + tuple(shape))
+
+
+class ReplayMemory:
+    """
+    Fixed-capacity ring buffer of episodes of binary observations of shape
+    state_shape, the last axis being planes. Call start_episode with the
+    first observation of an episode, then add once per move with the
+    action taken, the reward and the observation that followed.
+    """
+
+    def __init__(self, capacity, state_shape, rng=np.random, directory=None):
+        if capacity < 2:
+            raise ValueError("Replay memory needs room for two frames")
+        self.capacity = capacity
+        self.state_shape = tuple(state_shape)
+        self.rng = rng
+        self.directory = directory
+        # Held while writing, and by MinibatchPrefetcher while sampling
+        self.lock = threading.RLock()
+        self.position = -1  # slot of the latest frame
+        self.size = 0       # frames stored
+        self.count = 0      # transitions that can be sampled
+        self.written = 0    # frames ever written, the serial of the latest
+        self.walls_planes = []
+        self.walls_id = 0
+
+        meta = self.read_meta()
+        *cells, num_planes = state_shape
+        self.frame_shape = tuple(cells) + (num_planes - 1,)
+        frame_bytes = -(-int(np.prod(self.frame_shape)) // 8)
+        self.frames = self.allocate('frames', (capacity, frame_bytes),
+                                    np.uint8, meta)
+        slots = (capacity,)
+        self.walls_ids = self.allocate('walls_ids', slots, np.uint8, meta)
+        self.serials = self.allocate('serials', slots, np.uint64, meta)
+        self.actions = self.allocate('actions', slots, np.uint8, meta)
+        self.rewards = self.allocate('rewards', slots, np.float32, meta)
+        self.terminals = self.allocate('terminals', slots, np.bool_, meta)
+        self.valid = self.allocate('valid', slots, np.bool_, meta)
+
+        if meta is not None:
+            self.position = meta['position']
+            self.size = meta['size']
+            self.written = meta['written']
+            self.walls_planes = [np.array(walls, np.float32)
+                                 for walls in meta['walls_planes']]
+            # Frames written after the description may belong to an
+            # episode that will never be finished, and the latest frame
+            # described is followed by the next episode's first
+            self.valid[self.serials > self.written] = False
+            if self.position >= 0:
+                self.valid[self.position] = False
+            self.count = int(np.count_nonzero(self.valid))
+
+    def __len__(self):
+        return self.count
+
+    def meta_path(self):
+        """ Path of the JSON file describing a replay directory """
+        return os.path.join(self.directory, 'replay.json')
+
+    def read_meta(self):
+        """ The description of the replay stored in directory, or None if
+        there is none of this capacity and shape """
+        if self.directory is None or not os.path.exists(self.meta_path()):
+            return None
+        with open(self.meta_path(), encoding='utf-8') as meta_file:
+            meta = json.load(meta_file)
+        if (meta['capacity'] != self.capacity
+                or tuple(meta['state_shape']) != self.state_shape):
+            return None
+        return meta
+
+    def describe(self):
+        """ JSON-serialisable description of the memory's contents """
+        return {'capacity': self.capacity,
+                'state_shape': self.state_shape,
+                'position': self.position,
+                'size': self.size,
+                'written': self.written,
+                'walls_planes': [walls.tolist()
+                                 for walls in self.walls_planes]}
+
+    def write_meta(self, path=None):
+        """ Write describe() to path, by default the meta file of
+        directory """
+        if path is None:
+            if self.directory is None:
+                return
+            path = self.meta_path()
+        with open(path + '.tmp', 'w', encoding='utf-8') as meta_file:
+            json.dump(self.describe(), meta_file)
+        os.replace(path + '.tmp', path)
+
+    def allocate(self, name, shape, dtype, meta):
+        """ A zeroed array, or a memory-mapped one in directory that is
+        reopened when meta says it holds a replay """
+        if self.directory is None:
+            return np.zeros(shape, dtype)
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, name + '.npy')
+        if meta is not None and os.path.exists(path):
+            return np.lib.format.open_memmap(path, mode='r+')
+        return np.lib.format.open_memmap(path, mode='w+', dtype=dtype,
+                                         shape=shape)
+
+    def arrays(self):
+        """ The per-slot arrays, by file name """
+        return {'frames': self.frames, 'walls_ids': self.walls_ids,
+                'serials': self.serials, 'actions': self.actions,
+                'rewards': self.rewards, 'terminals': self.terminals,
+                'valid': self.valid}
+
+    def flush(self):
+        """ Write memory-mapped arrays and the description to disk """
+        if self.directory is None:
+            return
+        for array in self.arrays().values():
+            array.flush()
+        self.write_meta()
+
+    def save(self, directory):
+        """ Snapshot the filled slots into .npy files and a replay.json in
+        directory, copying SNAPSHOT_CHUNK slots at a time """
+        with self.lock:
+            os.makedirs(directory, exist_ok=True)
+            size = self.size
+            for name, array in self.arrays().items():
+                copy = np.lib.format.open_memmap(
+                    os.path.join(directory, name + '.npy'), mode='w+',
+                    dtype=array.dtype, shape=(size,) + array.shape[1:])
+                for start in range(0, size, SNAPSHOT_CHUNK):
+                    end = min(start + SNAPSHOT_CHUNK, size)
+                    copy[start:end] = array[start:end]
+                copy.flush()
+                del copy
+            self.write_meta(os.path.join(directory, 'replay.json'))
+
+    def load(self, directory):
+        """ Replace the contents with a snapshot written by save and
+        return its description """
+        with self.lock:
+            with open(os.path.join(directory, 'replay.json'),
+                      encoding='utf-8') as meta_file:
+                meta = json.load(meta_file)
+            if (meta['capacity'] != self.capacity
+                    or tuple(meta['state_shape']) != self.state_shape):
+                raise ValueError("Replay snapshot in " + directory
+                                 + " does not match the memory's capacity"
+                                 " and state shape")
+            size = meta['size']
+            for name, array in self.arrays().items():
+                stored = np.load(os.path.join(directory, name + '.npy'),
+                                 mmap_mode='r')
+                for start in range(0, size, SNAPSHOT_CHUNK):
+                    end = min(start + SNAPSHOT_CHUNK, size)
+                    array[start:end] = stored[start:end]
+            self.valid[size:] = False
+            self.position = meta['position']
+            self.size = size
+            self.written = meta['written']
+            self.count = int(np.count_nonzero(self.valid))
+            self.walls_planes = [np.array(walls, np.float32)
+                                 for walls in meta['walls_planes']]
+            self.write_meta()
+            return meta
+
+    def invalidate(self, i):
+        """ Stop the transition in slot i from being sampled """
+        if self.valid[i]:
+            self.valid[i] = False
+            self.count -= 1
+
+    def write_frame(self, observation):
+        """ Store the dynamic planes of observation in the next slot,
+        dropping the transition that slot held """
+        i = (self.position + 1) % self.capacity
+        self.invalidate(i)
+        self.frames[i] = pack_planes(observation[..., WALLS + 1:])
+        self.walls_ids[i] = self.walls_id
+        self.written += 1
+        self.serials[i] = self.written
+        self.position = i
+        self.size = min(self.size + 1, self.capacity)
+
+    def start_episode(self, state):
+        """ Store the first observation of an episode, registering the
+        walls plane of its layout """
+        with self.lock:
+            walls = state[..., WALLS:WALLS + 1].astype(np.float32)
+            for walls_id, known in enumerate(self.walls_planes):
+                if np.array_equal(known, walls):
+                    break
+            else:
+                walls_id = len(self.walls_planes)
+                if walls_id > np.iinfo(self.walls_ids.dtype).max:
+                    raise ValueError("Too many layouts in one replay memory")
+                self.walls_planes.append(walls)
+            self.walls_id = walls_id
+            # The previous frame never leads into a new episode
+            if self.position >= 0:
+                self.invalidate(self.position)
+            self.write_frame(state)
+            self.write_meta()
+
+    def add(self, action, reward, next_state, terminal):
+        """ Store the transition from the latest frame to next_state """
+        with self.lock:
+            i = self.position
+            self.actions[i] = action
+            self.rewards[i] = reward
+            self.terminals[i] = terminal
+            self.write_frame(next_state)
+            self.valid[i] = True
+            self.count += 1
+            if terminal:
+                self.write_meta()
+
+    def sample_indices(self, batch_size, rng=None):
+        """ Uniformly drawn slots of stored transitions, using rng if given
+        instead of the memory's own """
+        rng = self.rng if rng is None else rng
+        indices = rng.randint(0, self.size, batch_size)
+        redraw = ~self.valid[indices]
+        while redraw.any():
+            indices[redraw] = rng.randint(0, self.size, redraw.sum())
+            redraw = ~self.valid[indices]
+        return indices
+
+    def gather_walls(self, indices):
+        """ Walls planes for indices: a single (1, width, height, 1) plane
+        when they share a layout, one per index otherwise """
+        walls_ids = self.walls_ids[indices]
+        first = walls_ids[0]
+        if (walls_ids == first).all():
+            return self.walls_planes[first][np.newaxis]
+        return np.stack(self.walls_planes)[walls_ids]
+
+    def gather(self, indices):
+        """ Return the (states, one-hot actions, terminals, next states,
+        rewards, walls) minibatch for indices, in the order DQN.train
+        takes. States hold the dynamic planes only """
+        actions = np.eye(NUM_ACTIONS, dtype=np.float32)[self.actions[indices]]
+        next_indices = (indices + 1) % self.capacity
+        return (unpack_planes(self.frames[indices], self.frame_shape),
+                actions, self.terminals[indices].astype(np.float32),
+                unpack_planes(self.frames[next_indices], self.frame_shape),
+                self.rewards[indices], self.gather_walls(indices))
+
+    def sample(self, batch_size):
+        """ Gather a uniformly sampled minibatch """
+        return self.gather(self.sample_indices(batch_size))
+
+    def draw(self, batch_size, rng=None, beta=None):
+        """ Sample slots and return (indices, serials, minibatch, weights),
+        all taken under one hold of the lock. serials identify the frames
+        the slots held, for update_priorities; weights are the
+        importance-sampling weights for beta, None without priorities """
+        with self.lock:
+            indices = self.sample_indices(batch_size, rng)
+            return indices, self.serials[indices], self.gather(indices), None
+
+
+class SumTree:
+    """
+    Binary tree over capacity leaves (rounded up to a power of two) in
+    which every node holds the sum of its children, for O(log n) updates
+    and proportional sampling. Both operate on whole batches of leaves.
+    """
+
+    def __init__(self, capacity):
+        self.leaves = 1 << max(capacity - 1, 1).bit_length()
+        self.depth = self.leaves.bit_length() - 1
+        self.nodes = np.zeros(2 * self.leaves, np.float64)
+
+    def total(self):
+        """ Sum of all leaves """
+        return self.nodes[1]
+
+    def get(self, indices):
+        """ Values of leaves """
+        return self.nodes[self.leaves + np.asarray(indices)]
+
+    def set(self, indices, values):
+        """ Set leaves to values and update their ancestors """
+        nodes = self.leaves + np.asarray(indices)
+        self.nodes[nodes] = values
+        for _ in range(self.depth):
+            nodes = np.unique(nodes >> 1)
+            sums = self.nodes[2 * nodes] + self.nodes[2 * nodes + 1]
+            self.nodes[nodes] = sums
+
+    def find(self, values):
+        """ Leaves whose cumulative range contains each of values, which
+        lie in [0, total()) """
+        values = np.array(values, np.float64)
+        nodes = np.ones(len(values), np.intp)
+        for _ in range(self.depth):
+            left = 2 * nodes
+            left_sums = self.nodes[left]
+            right = values >= left_sums
+            values -= np.where(right, left_sums, 0.)
+            nodes = left + right
+        return nodes - self.leaves
+
+
+class PrioritizedReplayMemory(ReplayMemory):
+    """
+    ReplayMemory that samples transitions in proportion to priority ** alpha,
+    where a transition's priority is its last absolute TD error plus eps.
+    New transitions get the highest priority seen so far, so every one is
+    replayed at least once. Unsampleable slots have priority zero.
+    """
+
+    def __init__(self, capacity, state_shape, rng=np.random, directory=None,
+                 alpha=0.6, eps=1e-6):
+        super().__init__(capacity, state_shape, rng, directory)
+        self.alpha = alpha
+        self.eps = eps
+        self.max_priority = 1.
+        self.tree = SumTree(capacity)
+        # Transitions of a reopened replay start out equally likely
+        self.tree.set(np.flatnonzero(self.valid), 1.)
+
+    def invalidate(self, i):
+        super().invalidate(i)
+        self.tree.set([i], 0.)
+
+    def add(self, action, reward, next_state, terminal):
+        with self.lock:
+            i = self.position
+            super().add(action, reward, next_state, terminal)
+            self.tree.set([i], self.max_priority ** self.alpha)
+
+    def sample_indices(self, batch_size, rng=None):
+        """ Slots drawn in proportion to priority, one from each of
+        batch_size equal segments of the total """
+        rng = self.rng if rng is None else rng
+        total = self.tree.total()
+        values = (np.arange(batch_size) + rng.rand(batch_size)) \
+            * (total / batch_size)
+        indices = self.tree.find(np.minimum(values, np.nextafter(total, 0)))
+        # Rounding can land on an empty leaf next to a segment boundary
+        redraw = self.tree.get(indices) <= 0
+        while redraw.any():
+            values = rng.rand(redraw.sum()) * total
+            indices[redraw] = self.tree.find(values)
+            redraw = self.tree.get(indices) <= 0
+        return indices
+
+    def importance_weights(self, indices, beta):
+        """ Importance-sampling weights (count * P(i)) ** -beta of indices,
+        scaled so that the largest is 1 """
+        probabilities = self.tree.get(indices) / self.tree.total()
+        weights = (self.count * probabilities) ** -beta
+        return (weights / weights.max()).astype(np.float32)
+
+    def draw(self, batch_size, rng=None, beta=None):
+        with self.lock:
+            indices, serials, batch, _ = super().draw(batch_size, rng)
+            weights = None
+            if beta is not None:
+                weights = self.importance_weights(indices, beta)
+            return indices, serials, batch, weights
+
+    def describe(self):
+        meta = super().describe()
+        meta['max_priority'] = self.max_priority
+        return meta
+
+    def save(self, directory):
+        with self.lock:
+            super().save(directory)
+            np.save(os.path.join(directory, 'priorities.npy'),
+                    self.tree.get(np.arange(self.size)))
+
+    def load(self, directory):
+        """ Replace the contents with a snapshot written by save, with
+        equal priorities if it was taken without them """
+        with self.lock:
+            meta = super().load(directory)
+            self.tree.nodes[:] = 0.
+            path = os.path.join(directory, 'priorities.npy')
+            if os.path.exists(path):
+                self.tree.set(np.arange(self.size), np.load(path))
+                self.max_priority = meta['max_priority']
+            else:
+                self.tree.set(np.flatnonzero(self.valid), 1.)
+            return meta
+
+    def update_priorities(self, indices, serials, td_errors):
+        """ Set the priorities of indices from their TD errors, skipping
+        slots that were written again since draw returned their serials """
+        with self.lock:
+            priorities = np.abs(td_errors) + self.eps
+            self.max_priority = max(self.max_priority,
+                                    float(priorities.max()))
+            same = self.serials[indices] == serials
+            self.tree.set(indices[same], priorities[same] ** self.alpha)
+
+
+class MinibatchPrefetcher:
+    """
+    Samples and gathers minibatches from a replay memory in a daemon
+    thread, keeping up to depth of them ready in a bounded queue so that
+    batch assembly overlaps with training and game play. Each batch comes
+    from ReplayMemory.draw, so its importance-sampling weights (for the
+    beta set when it was drawn) are consistent with it, and it uses the
+    prefetcher's own random state. Batches may be a few transitions (and,
+    with priorities, a few updates) behind the memory; update_priorities
+    ignores the slots that were overwritten in the meantime.
+    """
+
+    def __init__(self, memory, batch_size, depth=4, seed=None, beta=None):
+        self.memory = memory
+        self.batch_size = batch_size
+        self.rng = np.random.RandomState(seed)
+        # Importance-sampling exponent of batches drawn from now on
+        self.beta = beta
+        self.batches = queue.Queue(maxsize=depth)
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def run(self):
+        """ Fill the queue until stopped """
+        while not self.stopped.is_set():
+            drawn = self.memory.draw(self.batch_size, self.rng, self.beta)
+            while not self.stopped.is_set():
+                try:
+                    self.batches.put(drawn, timeout=0.1)
+                    break
+                except queue.Full:
+                    continue
+
+    def get(self):
+        """ Next (indices, serials, minibatch, weights), as returned by
+        ReplayMemory.draw """
+        return self.batches.get()
+
+    def stop(self):
+        """ Stop the thread and drop the batches it prepared """
+        self.stopped.set()
+        self.thread.join()
+        while not self.batches.empty():
+            self.batches.get_nowait()
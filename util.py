@@ -18,8 +18,10 @@
 import sys
 import inspect
 import heapq
+import collections
+import math
 import random
-import signal
+import threading
 import time
 
 
@@ -283,6 +285,159 @@ class PriorityQueueWithFunction(PriorityQueue):
         PriorityQueue.push(self, item, self.priority_function(item))
 
 
+_MASK_64 = (1 << 64) - 1
+
+
+def mix_hash(item):
+    """
+    Spreads hash(item) over 64 bits (the SplitMix64 finalizer), so that
+    probabilistic structures can slice independent bits out of it.
+    """
+    value = (hash(item) + 0x9E3779B97F4A7C15) & _MASK_64
+    value = ((value ^ (value >> 30)) * 0xBF58476D1CE4E5B9) & _MASK_64
+    value = ((value ^ (value >> 27)) * 0x94D049BB133111EB) & _MASK_64
+    return value ^ (value >> 31)
+
+
+class BoundedSet:
+    """
+      An exact set holding at most `capacity` items. Once full, adding a
+      new item evicts the oldest one, so memory stays constant however
+      many items are offered.
+    """
+
+    def __init__(self, capacity=100000):
+        self.capacity = capacity
+        self.items = collections.OrderedDict()
+
+    def add(self, item):
+        "Add 'item', evicting the oldest item if the set is full"
+        if item in self.items:
+            return
+        self.items[item] = None
+        if len(self.items) > self.capacity:
+            self.items.popitem(last=False)
+
+    def __contains__(self, item):
+        return item in self.items
+
+    def __len__(self):
+        return len(self.items)
+
+    def empty_copy(self):
+        "Returns an empty set with the same capacity"
+        return BoundedSet(self.capacity)
+
+
+class BloomFilter:
+    """
+      A Bloom filter sized for `capacity` items at the given false
+      positive rate. Membership tests may report false positives but never
+      false negatives; memory is fixed when the filter is created.
+    """
+
+    def __init__(self, capacity=1000000, error_rate=0.01):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.num_bits = max(8, int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2)))
+        self.num_hashes = max(1, int(round(
+            self.num_bits / capacity * math.log(2))))
+        self.bits = bytearray((self.num_bits + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item):
+        # Double hashing: k probes derived from two 32-bit halves
+        value = mix_hash(item)
+        first, second = value & 0xFFFFFFFF, (value >> 32) | 1
+        return [(first + i * second) % self.num_bits
+                for i in range(self.num_hashes)]
+
+    def add(self, item):
+        "Add 'item' to the filter"
+        new = False
+        for position in self._positions(item):
+            mask = 1 << (position & 7)
+            if not self.bits[position >> 3] & mask:
+                self.bits[position >> 3] |= mask
+                new = True
+        if new:
+            self.count += 1
+
+    def __contains__(self, item):
+        return all(self.bits[position >> 3] & (1 << (position & 7))
+                   for position in self._positions(item))
+
+    def __len__(self):
+        "Approximate number of distinct items added"
+        return self.count
+
+    def empty_copy(self):
+        "Returns an empty filter with the same sizing"
+        return BloomFilter(self.capacity, self.error_rate)
+
+
+class HyperLogLog:
+    """
+      A HyperLogLog distinct-item counter using 2**precision one-byte
+      registers. It cannot answer membership queries, only estimate how
+      many distinct items were added (standard error ~1.04/sqrt(2**p)).
+    """
+
+    def __init__(self, precision=14):
+        self.precision = precision
+        self.num_registers = 1 << precision
+        self.registers = bytearray(self.num_registers)
+        self.alpha = 0.7213 / (1 + 1.079 / self.num_registers)
+
+    def add(self, item):
+        "Add 'item' to the counter"
+        value = mix_hash(item)
+        index = value >> (64 - self.precision)
+        rest = value & ((1 << (64 - self.precision)) - 1)
+        rank = 64 - self.precision - rest.bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def count(self):
+        "Estimated number of distinct items added"
+        registers = self.num_registers
+        estimate = self.alpha * registers * registers / sum(
+            2.0 ** -rank for rank in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * registers and zeros:
+            # Small range correction (linear counting)
+            estimate = registers * math.log(registers / zeros)
+        return int(round(estimate))
+
+    def __len__(self):
+        return self.count()
+
+    def empty_copy(self):
+        "Returns an empty counter with the same precision"
+        return HyperLogLog(self.precision)
+
+
+VISIT_TRACKERS = ['off', 'exact', 'bloom', 'hll']
+
+
+def make_visit_tracker(mode, capacity=100000):
+    """
+    Builds a constant-memory tracker of visited states: a BoundedSet
+    ('exact'), a BloomFilter ('bloom') or a HyperLogLog ('hll'). Returns
+    None for 'off'.
+    """
+    if mode == 'off':
+        return None
+    if mode == 'exact':
+        return BoundedSet(capacity)
+    if mode == 'bloom':
+        return BloomFilter(capacity)
+    if mode == 'hll':
+        return HyperLogLog()
+    raise ValueError(f'Unknown visit tracker {mode}')
+
+
 def manhattan_distance(xy1, xy2):
     "Returns the Manhattan distance between points xy1 and xy2"
     return abs(xy1[0] - xy2[0]) + abs(xy1[1] - xy2[1])
@@ -690,50 +845,94 @@ def pause():
 
 # code to handle timeouts
 #
-# FIXME
-# NOTE: TimeoutFuncton is NOT reentrant.  Later timeouts will silently
-# disable earlier timeouts.  Could be solved by maintaining a global list
-# of active time outs.  Currently, questions which have test cases calling
-# this have all student code so wrapped.
+# Time budgets are deadlines on the monotonic high-resolution clock rather
+# than SIGALRM alarms, so they work in any thread or process, accept
+# fractional seconds and nest: each Deadline remembers the one it replaced
+# and restores it on exit.  A running call is never interrupted; the
+# overrun is detected when it returns, and long-running agents may poll
+# time_remaining() or check_deadline() to stop early.
+
+_DEADLINES = threading.local()
+
 
 class TimeoutFunctionException(Exception):
     " Add Timeout Exceptions "
 
 
-class TimeoutFunction:
-    """Class to Handling Timeout
+class Deadline:
+    """
+    A time budget in seconds measured with time.perf_counter.  A budget of
+    None never expires.  Used as a context manager it becomes the current
+    deadline of the calling thread.
     """
 
-    def __init__(self, function, timeout):
-        self.timeout = timeout
-        self.function = function
+    def __init__(self, budget):
+        self.budget = budget
+        self.start = time.perf_counter()
+        self.end = math.inf if budget is None else self.start + budget
+        self._outer = None
 
-    def handle_timeout(self, signum, frame):
+    def elapsed(self):
         """
-        Handling Timeout
+        Seconds since the deadline was created.
+        """
+        return time.perf_counter() - self.start
+
+    def remaining(self):
+        """
+        Seconds left before the deadline, negative once it has passed.
+        """
+        return self.end - time.perf_counter()
 
-        Raises
-        ------
-        TimeoutFunctionException
+    def expired(self):
         """
+        True once the budget has been used up.
+        """
+        return time.perf_counter() > self.end
+
+    def __enter__(self):
+        self._outer = getattr(_DEADLINES, 'current', None)
+        _DEADLINES.current = self
+        return self
+
+    def __exit__(self, *exc_info):
+        _DEADLINES.current = self._outer
+        self._outer = None
+        return False
+
+
+def time_remaining():
+    """
+    Seconds left on the innermost deadline of the calling thread, or
+    infinity when no deadline is active.
+    """
+    deadline = getattr(_DEADLINES, 'current', None)
+    return math.inf if deadline is None else deadline.remaining()
+
+
+def check_deadline():
+    """
+    Raises TimeoutFunctionException if the calling thread's current
+    deadline has passed.
+    """
+    if time_remaining() < 0:
         raise TimeoutFunctionException
 
+
+class TimeoutFunction:
+    """Calls function under a Deadline of timeout seconds and raises
+    TimeoutFunctionException if the call overran it.
+    """
+
+    def __init__(self, function, timeout):
+        self.timeout = timeout
+        self.function = function
+        self.time_taken = 0.0
+
     def __call__(self, *args, **keyArgs):
-        # If we have SIGALRM signal, use it to cause an exception if and
-        # when this function runs too long.  Otherwise check the time taken
-        # after the method has returned, and throw an exception then.
-        if hasattr(signal, 'SIGALRM'):
-            old = signal.signal(signal.SIGALRM, self.handle_timeout)
-            signal.alarm(self.timeout)
-            try:
-                result = self.function(*args, **keyArgs)
-            finally:
-                signal.signal(signal.SIGALRM, old)
-            signal.alarm(0)
-        else:
-            start_time = time.time()
+        with Deadline(self.timeout) as deadline:
             result = self.function(*args, **keyArgs)
-            time_elapsed = time.time() - start_time
-            if time_elapsed >= self.timeout:
-                self.handle_timeout(None, None)
+        self.time_taken = deadline.elapsed()
+        if deadline.expired():
+            raise TimeoutFunctionException
         return result